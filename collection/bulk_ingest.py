@@ -0,0 +1,322 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+import polars as pl
+
+from collection.ledger import JobLedger
+from collection.metrics import Measurement, MetricsReporter
+from collection.parser.abstract_parser import AbstractParser, DemoResult
+from collection.parser.segment_parser.parser import CachedSegmentParser, SegmentParser
+from collection.parser.segment_parser.tick_cache import TickCache
+from collection.parser.spray_parser.parser import SprayParser
+from collection.prescan import prescan_demos
+
+# rough constants for estimating the peak RSS of parsing a demo, measured on 64-tick HLTV demos
+DEMO_BYTES_PER_TICK = 1_500  # size of a .dem file per tick, used when the tick count is unknown
+TICK_ROW_BYTES = 1_000  # memory per tick of the tick frame and its copies, for all players together
+BASE_RSS = 512 * 2 ** 20  # interpreter, libraries, demo parser state
+
+
+@dataclass
+class DemoJob:
+    """A single .dem file to ingest."""
+    path: str
+    match_id: str
+    map_id: int
+    size: int
+    n_ticks: int = None
+    map_name: str = None
+
+    @property
+    def peak_rss(self) -> int:
+        return estimate_peak_rss(self.size, self.n_ticks)
+
+
+def estimate_peak_rss(size: int, n_ticks: int = None) -> int:
+    """Estimate the peak memory used while parsing a demo.
+
+    The demo parser holds the whole file, and the tick frame grows with the number of ticks.
+
+    :param size: size of the .dem file, in bytes.
+    :param n_ticks: number of ticks in the demo. Estimated from the file size if unknown.
+    :return: the estimated peak RSS, in bytes.
+    """
+    if n_ticks is None:
+        n_ticks = size // DEMO_BYTES_PER_TICK
+    return BASE_RSS + 2 * size + n_ticks * TICK_ROW_BYTES
+
+
+def total_memory() -> int:
+    """Get the physical memory of this machine, in bytes."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def find_demos(root: str) -> list[DemoJob]:
+    """Find all .dem files in a directory tree.
+
+    Each directory containing .dem files is treated as a match, named after the directory. Map IDs are assigned in
+    order of file name.
+
+    :param root: the root of the directory tree.
+    :return: a job for every .dem file.
+    """
+    jobs = []
+    for directory, _, files in os.walk(root):
+        match_id = os.path.basename(os.path.abspath(directory))
+        for map_id, file in enumerate(sorted(file for file in files if file.endswith(".dem"))):
+            path = os.path.join(directory, file)
+            jobs.append(DemoJob(path, match_id, map_id, os.path.getsize(path)))
+    return jobs
+
+
+def find_cached_demos(tick_cache: TickCache, map_filter: list[str] = None) -> list[DemoJob]:
+    """Find all demos in a tick cache.
+
+    The tick count of every demo is read from its Parquet metadata, so memory estimates are exact.
+
+    :param tick_cache: the tick cache.
+    :param map_filter: if given, only demos played on these maps.
+    :return: a job for every cached demo.
+    """
+    jobs = []
+    for path, _, match_id, map_id in tick_cache.entries(map_filter):
+        n_ticks = pl.scan_parquet(path).select(pl.len()).collect().item()
+        jobs.append(DemoJob(path, match_id, map_id, os.path.getsize(path), n_ticks))
+    return jobs
+
+
+def prescan(jobs: list[DemoJob], ledger: JobLedger = None, workers: int = None) -> list[DemoJob]:
+    """Fill in the map name and tick count of demos from their headers (see ``prescan_demos``).
+
+    :param jobs: the demos. Updated in place.
+    :param ledger: if given, headers recorded in the ledger are reused (unless the file size changed), and new headers
+                   are recorded.
+    :param workers: number of processes, defaults to the CPU count.
+    :return: the demos.
+    """
+    known = ledger.demo_headers() if ledger is not None else {}
+    unknown = [job.path for job in jobs if job.path not in known or known[job.path].size != job.size]
+    logging.info(f"prescanning {len(unknown)} demos, {len(jobs) - len(unknown)} already known")
+    if unknown:
+        headers = prescan_demos(unknown, workers=workers)
+        if ledger is not None:
+            ledger.record_headers(headers)
+        known.update((header.path, header) for header in headers)
+
+    for job in jobs:
+        header = known.get(job.path)
+        if header is not None and header.size == job.size:
+            job.map_name = header.map_name
+            job.n_ticks = header.n_ticks
+    return jobs
+
+
+def _parse_job(parser: AbstractParser, job: DemoJob) -> DemoResult:
+    return parser.parse_path(job.path, match_id=job.match_id, map_id=job.map_id)
+
+
+def _result(job: DemoJob, future: Future) -> DemoResult:
+    # outcome of a parse that may have failed outside the parser, e.g. in a worker process that died
+    try:
+        return future.result()
+    except BrokenProcessPool as e:
+        return DemoResult(job.path, job.map_id, 0.0, job.size, f"worker process died - {e}")
+    except Exception as e:
+        return DemoResult(job.path, job.map_id, 0.0, job.size, str(e))
+
+
+class BulkIngest:
+    """Parse a local directory tree of .dem files with many demos in flight at once.
+
+    Demos are parsed in separate processes. A new demo is only admitted while the sum of the estimated peak RSS of all
+    demos in flight stays within a memory budget, so many small demos run side by side while a few long overtime
+    maps don't push the machine into swap.
+
+    Demos are admitted longest first by default, so the long demos don't end up running alone at the end of a batch.
+    """
+
+    def __init__(
+            self,
+            parser: AbstractParser,
+            workers: int = None,
+            memory_budget: int = None,
+            ledger: JobLedger = None,
+            longest_first: bool = True,
+            skip_parsed: bool = True,
+    ):
+        """Constructor.
+
+        :param parser: the parser applied to every demo. Sent to the worker processes, so it must be picklable.
+        :param workers: max number of demos parsed at once, defaults to the CPU count.
+        :param memory_budget: max sum of the estimated peak RSS of demos in flight, in bytes. Defaults to 80% of
+                              physical memory.
+        :param ledger: if given, demos recorded as parsed are skipped, and the outcome of every demo is recorded.
+        :param longest_first: whether to admit demos in order of decreasing estimated peak RSS, which grows with the
+                              tick count. Otherwise, demos are admitted in the given order.
+        :param skip_parsed: whether to skip demos recorded as parsed in the ledger. Disable to re-extract the features
+                            of demos that were parsed before, e.g. from a tick cache.
+        """
+        self._parser = parser
+        self._workers = workers or os.cpu_count()
+        self._memory_budget = memory_budget or int(total_memory() * 0.8)
+        self._ledger = ledger
+        self._longest_first = longest_first
+        self._skip_parsed = skip_parsed
+
+    def run(self, jobs: list[DemoJob]) -> list[DemoResult]:
+        """Parse the given demos.
+
+        :param jobs: the demos to parse. Demos are admitted in this order (or longest first), except when the next demo
+                     does not fit in the remaining memory budget but a later one does.
+        :return: the outcome of every demo.
+        """
+        if self._ledger is not None and self._skip_parsed:
+            parsed = self._ledger.parsed_demos()
+            jobs = [job for job in jobs if (job.match_id, job.map_id) not in parsed]
+        logging.info(f"ingesting {len(jobs)} demos with {self._workers} workers, "
+                     f"{self._memory_budget / 2 ** 30:.1f} GiB budget")
+
+        pending = sorted(jobs, key=lambda job: job.peak_rss, reverse=True) if self._longest_first else list(jobs)
+        in_flight = {}
+        reserved = 0
+        results = []
+        executor = self._new_executor()
+        try:
+            while pending or in_flight:
+                # admit as many demos as fit, always admitting at least one so oversized demos still get parsed
+                while pending and len(in_flight) < self._workers:
+                    index = next(
+                        (i for i, job in enumerate(pending) if reserved + job.peak_rss <= self._memory_budget),
+                        None if in_flight else 0,
+                    )
+                    if index is None:
+                        break
+                    job = pending.pop(index)
+                    reserved += job.peak_rss
+                    in_flight[executor.submit(_parse_job, self._parser, job)] = job
+                self._parser.metrics.set_gauge("demos_in_flight", len(in_flight))
+                self._parser.metrics.set_gauge("reserved_bytes", reserved)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # a worker died (e.g. killed by the OOM killer), which takes every demo in flight down with it.
+                    # They are recorded as failed, and the remaining demos are parsed by a new pool
+                    logging.error(f"worker process died, {len(in_flight)} demos in flight failed")
+                    done, _ = wait(in_flight)
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = self._new_executor()
+                for future in done:
+                    job = in_flight.pop(future)
+                    reserved -= job.peak_rss
+                    results.append(self._complete(job, _result(job, future)))
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return results
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawn rather than fork, polars' thread pool does not survive a fork
+        context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self._workers, mp_context=context)
+
+    def _complete(self, job: DemoJob, result: DemoResult) -> DemoResult:
+        # metrics of the worker process are lost, record the demo-level numbers here
+        measurement = Measurement(seconds=result.seconds, bytes=result.bytes)
+        self._parser.metrics.record(
+            "parse_demo", measurement, demo=f"{job.match_id}/{job.map_id}", error=result.error is not None
+        )
+        if self._ledger is not None:
+            self._ledger.record_demo(job.match_id, job.map_id, job.path, result.seconds, result.bytes, result.error)
+        return result
+
+
+def main():
+    """Parse a local directory tree of .dem files."""
+    arg_parser = argparse.ArgumentParser(description="Parse a local directory tree of .dem files.")
+    arg_parser.add_argument("root", help="directory tree containing .dem files, or a tick cache with --from-cache")
+    arg_parser.add_argument("out", help="directory the parser writes its output to")
+    arg_parser.add_argument("--parser", choices=["segment", "spray"], default="segment")
+    arg_parser.add_argument("--segment-length", type=int, nargs="+", default=[5], help="in seconds, may be several")
+    arg_parser.add_argument("--map", action="append", dest="maps", help="map to keep, may be repeated")
+    arg_parser.add_argument("--workers", type=int, default=None)
+    arg_parser.add_argument("--memory-budget", type=float, default=None, help="in GiB")
+    arg_parser.add_argument("--tick-cache", default=None, help="directory to cache the tick data of every demo in")
+    arg_parser.add_argument("--from-cache", action="store_true", help="re-extract features from a tick cache")
+    arg_parser.add_argument("--stride", type=int, default=None, help="in seconds, for sliding windows")
+    arg_parser.add_argument("--rounds-per-chunk", type=int, default=None, help="parse demos a few rounds at a time")
+    arg_parser.add_argument("--feature", action="append", dest="features", help="feature to extract, may be repeated")
+    arg_parser.add_argument("--no-prescan", action="store_true", help="don't read demo headers before parsing")
+    arg_parser.add_argument("--output-format", choices=["csv", "parquet"], default="csv", help="of segment features")
+    arg_parser.add_argument("--spray-store", action="store_true", help="pack sprays into a store, not .npy files")
+    arg_parser.add_argument("--weapon", action="append", dest="weapons", help="to collect sprays of, may be repeated")
+    args = arg_parser.parse_args()
+    if args.parser != "segment" and (args.tick_cache or args.from_cache):
+        arg_parser.error("tick caching is only supported by the segment parser")
+    if args.parser != "segment" and args.stride:
+        arg_parser.error("sliding windows are only supported by the segment parser")
+    if args.parser != "spray" and (args.spray_store or args.weapons):
+        arg_parser.error("the spray store and weapons are only supported by the spray parser")
+
+    # demos are parsed in parallel already, so each demo parses its players serially
+    if args.from_cache:
+        parser = CachedSegmentParser(
+            args.out,
+            segment_length=args.segment_length,
+            processes=1,
+            stride=args.stride,
+            output_format=args.output_format,
+            features=args.features,
+        )
+        jobs = find_cached_demos(TickCache(args.root), map_filter=args.maps)
+    elif args.parser == "segment":
+        tick_cache = TickCache(args.tick_cache) if args.tick_cache else None
+        parser = SegmentParser(
+            args.out,
+            segment_length=args.segment_length,
+            map_filter=args.maps,
+            processes=1,
+            tick_cache=tick_cache,
+            stride=args.stride,
+            output_format=args.output_format,
+            rounds_per_chunk=args.rounds_per_chunk,
+            features=args.features,
+        )
+        jobs = find_demos(args.root)
+    else:
+        parser = SprayParser(
+            args.out,
+            weapon=args.weapons or "weapon_ak47",
+            output_format="store" if args.spray_store else "npy",
+        )
+        jobs = find_demos(args.root)
+    ledger = JobLedger(os.path.join(args.out, "ledger.sqlite"))
+    if not args.from_cache and not args.no_prescan:
+        jobs = prescan(jobs, ledger=ledger, workers=args.workers)
+        # demos outside the map filter are only parsed to fill the tick cache
+        if args.parser == "segment" and args.maps and not args.tick_cache:
+            jobs = [job for job in jobs if job.map_name is None or job.map_name in args.maps]
+    memory_budget = int(args.memory_budget * 2 ** 30) if args.memory_budget else None
+    # re-extracting from a tick cache typically targets demos that were parsed before (into the same output)
+    ingest = BulkIngest(
+        parser,
+        workers=args.workers,
+        memory_budget=memory_budget,
+        ledger=ledger,
+        skip_parsed=not args.from_cache,
+    )
+
+    with MetricsReporter(parser.metrics, args.out):
+        results = ingest.run(jobs)
+    n_failed = sum(result.error is not None for result in results)
+    logging.info(f"parsed {len(results) - n_failed} demos, {n_failed} failed")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    main()
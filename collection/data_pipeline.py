@@ -1,9 +1,19 @@
 import logging
 import os
+import shutil
 import sys
-from tempfile import TemporaryDirectory
+import time
+from tempfile import TemporaryDirectory, mkdtemp
+from typing import Iterator
 
+from collection.ledger import JobLedger
+from collection.metrics import Measurement, MetricsReporter
+from collection.parser.abstract_parser import DemoResult
 from collection.parser.segment_parser.parser import SegmentParser
+from collection.parser.segment_parser.tick_cache import TickCache
+from collection.scraper.cache import PageCache
+from collection.scraper.urls import ResultsUrl
+from collection.stages import Stage, run_stages
 from parser.abstract_parser import AbstractParser
 from scraper.hltv_scraper import HltvScraper
 
@@ -14,10 +24,56 @@ class DataPipeline:
     This pipeline produces .npy files containing raw player key/mouse information for downstream ML tasks.
     """
 
-    def __init__(self, res: str, scraper: HltvScraper, parser: AbstractParser):
+    def __init__(
+            self,
+            res: str,
+            scraper: HltvScraper,
+            parser: AbstractParser,
+            staged: bool = False,
+            download_workers: int = 2,
+            extract_workers: int = 1,
+            parse_workers: int = 1,
+            queue_size: int = 2,
+            streaming: bool = False,
+            metrics_interval: float = 30.0,
+            incremental: bool = False,
+    ):
+        """Constructor.
+
+        :param res: the resource directory.
+        :param scraper: the HLTV scraper.
+        :param parser: the parser applied to every downloaded demo.
+        :param staged: if True, download, extract, and parse demos concurrently in separate stages instead of one
+                       match at a time.
+        :param download_workers: number of concurrent downloads, when staged.
+        :param extract_workers: number of concurrent archive extractions, when staged.
+        :param parse_workers: number of matches parsed concurrently, when staged.
+        :param queue_size: max number of matches waiting between two stages, when staged. Bounds scratch disk use.
+        :param streaming: if True, extract .dem files from the archive one at a time and delete each one as soon as it
+                          is parsed, so scratch disk use is bounded by the archive plus a single demo.
+        :param metrics_interval: seconds between two writes of the metrics files (``metrics.json``, ``metrics.prom``)
+                                 to the resource directory.
+        :param incremental: if True, only scrape matches that are new since the last run, instead of reusing or
+                            rescraping the whole list of hrefs.
+        """
         self._resource_directory = os.path.abspath(res)
         self._scraper = scraper
         self._parser = parser
+        self._staged = staged
+        self._download_workers = download_workers
+        self._extract_workers = extract_workers
+        self._parse_workers = parse_workers
+        self._queue_size = queue_size
+        self._streaming = streaming
+        self._metrics_interval = metrics_interval
+        self._incremental = incremental
+        # share the parser's metrics, so parse-level and pipeline-level stages end up in the same report
+        self._metrics = parser.metrics
+
+        # progress is tracked per parser output directory, so a new parser (or output directory) starts from scratch
+        self._ledger = JobLedger(os.path.join(self._parser.directory, "ledger.sqlite"))
+        # carry over progress recorded by the old flag files
+        self._ledger.import_flags(os.path.join(self._parser.directory, ".parsed"))
 
     def get_match_hrefs(self) -> list[str]:
         """Get the match hrefs.
@@ -27,21 +83,15 @@ class DataPipeline:
 
         :return: the match hrefs.
         """
-        path = os.path.join(self._resource_directory, "match_hrefs.txt")
-
         # if file already exists, read and return data
-        if os.path.exists(path):
+        if (hrefs := self._read_hrefs("match_hrefs.txt")) is not None:
             print("match_hrefs.txt exists...")
-            with open(path, "r") as f:
-                hrefs = [line.rstrip() for line in f.readlines()]
-                return hrefs
+            return hrefs
 
         # otherwise we need to create the file first
-        os.makedirs(self._resource_directory, exist_ok=True)
-        hrefs = self._scraper.scrape_match_hrefs()
-        with open(path, "w") as f:
-            for href in hrefs:
-                f.write(f"{href}\n")
+        with self._metrics.timed("scrape_match_hrefs"):
+            hrefs = self._scraper.scrape_match_hrefs()
+        self._write_hrefs("match_hrefs.txt", hrefs)
         return hrefs
 
     def get_demo_hrefs(self, match_hrefs: list[str]) -> list[str]:
@@ -52,18 +102,66 @@ class DataPipeline:
 
         :return: the match hrefs.
         """
-        path = os.path.join(self._resource_directory, "demo_hrefs.txt")
-        if os.path.exists(path):
+        if (hrefs := self._read_hrefs("demo_hrefs.txt")) is not None:
             print("demo_hrefs.txt exists...")
-            with open(path, "r") as f:
-                hrefs = [line.rstrip() for line in f.readlines()]
-                return hrefs
+            return hrefs
+
+        with self._metrics.timed("scrape_demo_hrefs"):
+            hrefs = self._scraper.scrape_demo_hrefs(match_hrefs)
+        self._write_hrefs("demo_hrefs.txt", hrefs)
+        return hrefs
+
+    def update_hrefs(self) -> list[str]:
+        """Scrape the matches played since the last run, and resolve demo hrefs for those matches only.
 
-        hrefs = self._scraper.scrape_demo_hrefs(match_hrefs)
+        The results pages are walked newest-first, stopping at the first page whose matches are all known. The new
+        match hrefs are only saved once their demo hrefs are, so an interrupted update is picked up again next run.
+
+        :return: all demo hrefs, old and new.
+        """
+        match_hrefs = self._read_hrefs("match_hrefs.txt") or []
+        demo_hrefs = self._read_hrefs("demo_hrefs.txt") or []
+
+        end_date = self._scraper.results_url.end_date
+        if end_date is not None and end_date < time.strftime("%Y-%m-%d"):
+            logging.warning(f"results end on {end_date}, so no new matches will be found (use end_date=None)")
+
+        known_matches = set(match_hrefs)
+        with self._metrics.timed("scrape_match_hrefs"):
+            scraped = self._scraper.scrape_match_hrefs(known=known_matches)
+        new_match_hrefs = [href for href in dict.fromkeys(scraped) if href not in known_matches]
+        logging.info(f"{len(new_match_hrefs)} new matches")
+        if not new_match_hrefs:
+            return demo_hrefs
+
+        known_demos = set(demo_hrefs)
+        with self._metrics.timed("scrape_demo_hrefs"):
+            scraped = self._scraper.scrape_match_demo_hrefs(new_match_hrefs)
+        # matches whose page failed to download stay unknown, so they are scraped again next run
+        new_match_hrefs = [href for href in new_match_hrefs if scraped[href] is not None]
+        scraped = [href for match_href in new_match_hrefs for href in scraped[match_href]]
+        new_demo_hrefs = [href for href in dict.fromkeys(scraped) if href not in known_demos]
+
+        # keep both files newest first
+        demo_hrefs = new_demo_hrefs + demo_hrefs
+        self._write_hrefs("demo_hrefs.txt", demo_hrefs)
+        self._write_hrefs("match_hrefs.txt", new_match_hrefs + match_hrefs)
+        return demo_hrefs
+
+    def _read_hrefs(self, filename: str) -> list[str] | None:
+        """Read hrefs from a file in the resource directory, or None if the file does not exist."""
+        path = os.path.join(self._resource_directory, filename)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return [line.rstrip() for line in f.readlines()]
+
+    def _write_hrefs(self, filename: str, hrefs: list[str]):
+        os.makedirs(self._resource_directory, exist_ok=True)
+        path = os.path.join(self._resource_directory, filename)
         with open(path, "w") as f:
             for href in hrefs:
                 f.write(f"{href}\n")
-        return hrefs
 
     def download_demos(self, demo_hrefs: list[str]):
         """Download the .dem files.
@@ -73,57 +171,193 @@ class DataPipeline:
         and then parses the file into a parseable format and saves it in the resources directory.
         This enables storage of only the data we need without the overhead of storing large .dem files.
 
+        Progress is tracked in the job ledger: matches that were already parsed are skipped, and matches that failed
+        are retried.
+
         :param demo_hrefs: the demo hrefs.
         """
-        demo_directory = os.path.join(self._resource_directory, "demo")
-        if not os.path.exists(demo_directory):
-            os.makedirs(demo_directory)
-
-        for idx, demo_href in enumerate(demo_hrefs):
+        for idx, demo_href in enumerate(self._pending(demo_hrefs)):
             match_id = demo_href.split("/")[-1]
-            if self._parser.parsed(match_id):
-                # already attempted to download this href, continue on to next
-                logging.info(f"skipping demo {match_id}...")
-                continue
-
             logging.info(f"{idx}\tdownloading demo {match_id}...")
+            self._ledger.start(match_id)
 
             # create temp directory to hold working files
-            with TemporaryDirectory() as tmpdir:
-                self.download_demo(match_id, demo_href, tmpdir)
-
-            # create flag to indicate that this demo has been downloaded
-            self._parser.mark_parsed(match_id)
+            n_bytes = None
+            try:
+                with TemporaryDirectory() as tmpdir:
+                    n_bytes, results = self.download_demo(match_id, demo_href, tmpdir)
+            except Exception as e:
+                logging.error(f"could not download {match_id} - {e}")
+                self._ledger.fail(match_id, str(e), n_bytes)
+                continue
+            self._finish(match_id, n_bytes, results)
 
-    def download_demo(self, match_id: str, demo_href: str, directory: str):
+    def download_demo(self, match_id: str, demo_href: str, directory: str) -> tuple[int, list[DemoResult]]:
         """Download a match, and parse the demos contained within.
 
         :param match_id: the ID of the match.
         :param demo_href: the href of the demo on HLTV.
         :param directory: the directory to download the demo to.
-]        """
+        :return: the size of the downloaded archive, and the outcome of parsing each demo.
+        """
         # 1. scrape demo and extract archive to directory
-        self._scraper.scrape_demos(demo_href, directory)
+        archive_path, n_bytes = self._download(match_id, demo_href, directory)
+        if self._streaming:
+            # demos are extracted lazily, as the parser gets to them
+            return n_bytes, self._parser.parse_paths(self._iter_demos(match_id, archive_path, directory), match_id)
+        self._extract(match_id, archive_path, directory)
         logging.debug("scraped demos")
 
         # 2. parse demos within directory, and do whatever the parser does with them
         # (most likely implementation is to apply some transformation to the .dem file
         #  and save it to the /res directory)
-        self._parser.parse_directory(directory, match_id=match_id)
+        results = self._parser.parse_directory(directory, match_id=match_id)
         logging.debug("parsed demos")
+        return n_bytes, results
+
+    def download_demos_staged(self, demo_hrefs: list[str]):
+        """Download the .dem files, with downloading, extracting, and parsing overlapped.
+
+        Each step runs as a separate stage with its own worker threads, connected by bounded queues. While one match
+        is being parsed, the next ones are already being downloaded and extracted. Each match gets its own scratch
+        directory, which is removed once the match is parsed (or fails).
+
+        When streaming, extraction happens inside the parse stage, one demo at a time.
+
+        :param demo_hrefs: the demo hrefs.
+        """
+        download = Stage("download", self._download_stage, workers=self._download_workers, queue_size=self._queue_size)
+        if self._streaming:
+            stages = [
+                download,
+                Stage("parse", self._stream_stage, workers=self._parse_workers, queue_size=self._queue_size),
+            ]
+        else:
+            stages = [
+                download,
+                Stage("extract", self._extract_stage, workers=self._extract_workers, queue_size=self._queue_size),
+                Stage("parse", self._parse_stage, workers=self._parse_workers, queue_size=self._queue_size),
+            ]
+        run_stages(self._pending(demo_hrefs), stages, metrics=self._metrics)
+
+    def _download(self, match_id: str, demo_href: str, directory: str) -> tuple[str, int]:
+        with self._metrics.timed("download", demo=match_id) as measurement:
+            archive_path = self._scraper.download_archive(demo_href, directory)
+            measurement.bytes = os.path.getsize(archive_path)
+        return archive_path, measurement.bytes
+
+    def _extract(self, match_id: str, archive_path: str, directory: str):
+        with self._metrics.timed("extract", demo=match_id) as measurement:
+            measurement.bytes = os.path.getsize(archive_path)
+            self._scraper.extract_archive(archive_path, directory)
+
+    def _iter_demos(self, match_id: str, archive_path: str, directory: str) -> Iterator[str]:
+        """Extract demos from an archive one at a time (see ``HltvScraper.iter_demos``), timing each extraction."""
+        demos = self._scraper.iter_demos(archive_path, directory)
+        try:
+            while True:
+                start = time.perf_counter()
+                path = next(demos, None)
+                if path is None:
+                    return
+                measurement = Measurement(seconds=time.perf_counter() - start, bytes=os.path.getsize(path))
+                self._metrics.record("extract", measurement, demo=match_id)
+                yield path
+        finally:
+            demos.close()
+
+    def _pending(self, demo_hrefs: list[str]) -> list[str]:
+        """Register the demo hrefs in the ledger, and return those that still need to be downloaded and parsed."""
+        self._ledger.enqueue(demo_hrefs)
+        pending = self._ledger.pending()
+        logging.info(f"{len(pending)} of {len(demo_hrefs)} demos pending")
+        return pending
+
+    def _finish(self, match_id: str, n_bytes: int, results: list[DemoResult]):
+        """Record the outcome of a match in the ledger. The match only counts as parsed if all of its demos were."""
+        for result in results:
+            self._ledger.record_demo(match_id, result.map_id, result.path, result.seconds, result.bytes, result.error)
+        errors = [f"{os.path.basename(result.path)}: {result.error}" for result in results if result.error]
+        if errors:
+            self._ledger.fail(match_id, "; ".join(errors), n_bytes)
+        elif not results:
+            self._ledger.fail(match_id, "no demos found", n_bytes)
+        else:
+            self._ledger.finish(match_id, n_bytes)
+
+    def _download_stage(self, demo_href: str) -> tuple[str, str, str]:
+        match_id = demo_href.split("/")[-1]
+        logging.info(f"downloading demo {match_id}...")
+        self._ledger.start(match_id)
+        directory = mkdtemp(prefix=f"{match_id}-")
+        try:
+            archive_path, _ = self._download(match_id, demo_href, directory)
+        except Exception as e:
+            shutil.rmtree(directory, ignore_errors=True)
+            self._ledger.fail(match_id, str(e))
+            raise
+        return match_id, archive_path, directory
+
+    def _extract_stage(self, item: tuple[str, str, str]) -> tuple[str, int, str]:
+        match_id, archive_path, directory = item
+        n_bytes = os.path.getsize(archive_path)
+        try:
+            self._extract(match_id, archive_path, directory)
+            # archive is no longer needed, free up the scratch space before the match waits in the parse queue
+            os.remove(archive_path)
+        except Exception as e:
+            shutil.rmtree(directory, ignore_errors=True)
+            self._ledger.fail(match_id, str(e), n_bytes)
+            raise
+        return match_id, n_bytes, directory
+
+    def _parse_stage(self, item: tuple[str, int, str]) -> str:
+        match_id, n_bytes, directory = item
+        try:
+            results = self._parser.parse_directory(directory, match_id=match_id)
+        except Exception as e:
+            self._ledger.fail(match_id, str(e), n_bytes)
+            raise
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        self._finish(match_id, n_bytes, results)
+        return match_id
+
+    def _stream_stage(self, item: tuple[str, str, str]) -> str:
+        match_id, archive_path, directory = item
+        n_bytes = os.path.getsize(archive_path)
+        try:
+            demo_paths = self._iter_demos(match_id, archive_path, directory)
+            results = self._parser.parse_paths(demo_paths, match_id=match_id)
+        except Exception as e:
+            self._ledger.fail(match_id, str(e), n_bytes)
+            raise
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        self._finish(match_id, n_bytes, results)
+        return match_id
 
     def run(self):
         """Run the data collection pipeline."""
-        # 1. get match hrefs
-        match_hrefs = self.get_match_hrefs()
-        logging.info("match hrefs collected")
-
-        # 2. get demo hrefs
-        demo_hrefs = self.get_demo_hrefs(match_hrefs)
-        logging.info("demo hrefs collected")
+        if self._incremental:
+            # 1-2. get demo hrefs of new matches
+            demo_hrefs = self.update_hrefs()
+            logging.info("demo hrefs updated")
+        else:
+            # 1. get match hrefs
+            match_hrefs = self.get_match_hrefs()
+            logging.info("match hrefs collected")
+
+            # 2. get demo hrefs
+            demo_hrefs = self.get_demo_hrefs(match_hrefs)
+            logging.info("demo hrefs collected")
 
         # 3. download demos and process into npy arrays
-        self.download_demos(demo_hrefs)
+        with MetricsReporter(self._metrics, self._resource_directory, self._metrics_interval):
+            if self._staged:
+                self.download_demos_staged(demo_hrefs)
+            else:
+                self.download_demos(demo_hrefs)
 
 
 def main():
@@ -132,10 +366,15 @@ def main():
     Instantiates scraper, parser, and data collection pipeline. It then runs the pipeline.
     """
 
-    scraper = HltvScraper(headless=False)
-    parser = SegmentParser(directory="res/mnk5-dust2", segment_length=5, map_filter=["de_dust2"])
-    pipeline = DataPipeline("res/", scraper=scraper, parser=parser)
-    pipeline.run()
+    with (
+        # incremental runs look for new matches, up to today
+        HltvScraper(headless=False, cache=PageCache("res/cache"), results_url=ResultsUrl(end_date=None)) as scraper,
+        SegmentParser(
+            directory="res/mnk5-dust2", segment_length=5, map_filter=["de_dust2"], tick_cache=TickCache("res/ticks")
+        ) as parser,
+    ):
+        pipeline = DataPipeline("res/", scraper=scraper, parser=parser, staged=True, streaming=True, incremental=True)
+        pipeline.run()
 
 
 if __name__ == "__main__":
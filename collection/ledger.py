@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import threading
+import time
+
+from collection.prescan import DemoHeader
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+PARSED = "parsed"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    match_id TEXT PRIMARY KEY,
+    demo_href TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    queued_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    bytes INTEGER,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS demos (
+    match_id TEXT NOT NULL,
+    map_id INTEGER NOT NULL,
+    path TEXT,
+    state TEXT NOT NULL,
+    seconds REAL,
+    bytes INTEGER,
+    error TEXT,
+    PRIMARY KEY (match_id, map_id)
+);
+CREATE TABLE IF NOT EXISTS demo_headers (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    map_name TEXT,
+    n_ticks INTEGER,
+    n_rounds INTEGER
+);
+CREATE INDEX IF NOT EXISTS matches_state ON matches (state);
+"""
+
+
+class JobLedger:
+    """Embedded SQLite ledger tracking the state of every match (and every demo within it) in the data pipeline.
+
+    Matches move through the states queued -> downloading -> parsed, or end up failed. A match is only marked parsed
+    once every demo in it parsed successfully, so failed work is retried on the next run.
+
+    The ledger may be shared between threads.
+    """
+
+    def __init__(self, path: str):
+        """Open (or create) a ledger.
+
+        :param path: path of the SQLite database file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def _execute(self, sql: str, params=()):
+        with self._lock, self._connection:
+            return self._connection.execute(sql, params).fetchall()
+
+    def enqueue(self, demo_hrefs: list[str]):
+        """Add demo hrefs to the ledger. Hrefs that are already known keep their state.
+
+        :param demo_hrefs: the demo hrefs. The match ID is the last component of the href.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO matches (match_id, demo_href, state, queued_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (match_id) DO UPDATE SET demo_href = excluded.demo_href WHERE demo_href IS NULL",
+                [(href.split("/")[-1], href, QUEUED, now) for href in demo_hrefs],
+            )
+
+    def import_flags(self, parsed_directory: str):
+        """Import matches marked parsed by the old ``.parsed`` flag files. The flag files are imported on every run, so
+        matches already in the ledger keep their state.
+
+        :param parsed_directory: the directory containing one empty flag file per parsed match.
+        """
+        if not os.path.isdir(parsed_directory):
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO matches (match_id, state, finished_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (match_id) DO NOTHING",
+                [(match_id, PARSED, now) for match_id in os.listdir(parsed_directory)],
+            )
+
+    def pending(self, max_attempts: int = 3) -> list[str]:
+        """Get the demo hrefs of every match that still needs work.
+
+        This covers queued matches, failed matches, and matches interrupted while downloading (e.g. by a crash).
+
+        :param max_attempts: matches that have already been attempted this many times are given up on.
+        :return: the demo hrefs, in the order they were enqueued.
+        """
+        rows = self._execute(
+            "SELECT demo_href FROM matches WHERE state != ? AND attempts < ? AND demo_href IS NOT NULL ORDER BY rowid",
+            (PARSED, max_attempts),
+        )
+        return [href for href, in rows]
+
+    def start(self, match_id: str):
+        """Mark a match as downloading, counting a new attempt."""
+        self._execute(
+            "UPDATE matches SET state = ?, attempts = attempts + 1, started_at = ?, finished_at = NULL, error = NULL "
+            "WHERE match_id = ?",
+            (DOWNLOADING, time.time(), match_id),
+        )
+
+    def finish(self, match_id: str, n_bytes: int = None):
+        """Mark a match as parsed.
+
+        :param match_id: the match ID.
+        :param n_bytes: size of the downloaded archive.
+        """
+        self._execute(
+            "UPDATE matches SET state = ?, finished_at = ?, bytes = ? WHERE match_id = ?",
+            (PARSED, time.time(), n_bytes, match_id),
+        )
+
+    def fail(self, match_id: str, error: str, n_bytes: int = None):
+        """Mark a match as failed.
+
+        :param match_id: the match ID.
+        :param error: description of the failure.
+        :param n_bytes: size of the downloaded archive, if it was downloaded.
+        """
+        self._execute(
+            "UPDATE matches SET state = ?, finished_at = ?, bytes = COALESCE(?, bytes), error = ? WHERE match_id = ?",
+            (FAILED, time.time(), n_bytes, error, match_id),
+        )
+
+    def record_demo(self, match_id: str, map_id: int, path: str, seconds: float, n_bytes: int, error: str = None):
+        """Record the outcome of parsing a single demo.
+
+        :param match_id: the match ID.
+        :param map_id: the map ID.
+        :param path: path the demo was parsed from.
+        :param seconds: time spent parsing the demo.
+        :param n_bytes: size of the demo file.
+        :param error: description of the failure, if parsing failed.
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO demos (match_id, map_id, path, state, seconds, bytes, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (match_id, map_id, path, FAILED if error else PARSED, seconds, n_bytes, error),
+        )
+
+    def parsed_demos(self) -> set[tuple[str, int]]:
+        """Get the (match ID, map ID) of every demo that was parsed successfully."""
+        return set(self._execute("SELECT match_id, map_id FROM demos WHERE state = ?", (PARSED,)))
+
+    def record_headers(self, headers: list[DemoHeader]):
+        """Record the prescanned headers of demos, replacing earlier headers of the same paths."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO demo_headers (path, size, map_name, n_ticks, n_rounds) VALUES (?, ?, ?, ?, ?)",
+                [(header.path, header.size, header.map_name, header.n_ticks, header.n_rounds) for header in headers],
+            )
+
+    def demo_headers(self) -> dict[str, DemoHeader]:
+        """Get the prescanned header of every demo, by path."""
+        rows = self._execute("SELECT path, size, map_name, n_ticks, n_rounds FROM demo_headers")
+        return {row[0]: DemoHeader(*row) for row in rows}
+
+    def counts(self) -> dict[str, int]:
+        """Get the number of matches in each state."""
+        return dict(self._execute("SELECT state, COUNT(*) FROM matches GROUP BY state"))
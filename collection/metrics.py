@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+
+@dataclass
+class Measurement:
+    """Quantities recorded for a single call of a pipeline stage."""
+    seconds: float = 0.0
+    bytes: int = 0
+    ticks: int = 0
+    segments: int = 0
+    events: int = 0
+
+
+@dataclass
+class StageStats:
+    """Running totals of a pipeline stage."""
+    calls: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+    ticks: int = 0
+    segments: int = 0
+    events: int = 0
+
+    def add(self, measurement: Measurement, error: bool):
+        self.calls += 1
+        self.errors += int(error)
+        self.seconds += measurement.seconds
+        self.bytes += measurement.bytes
+        self.ticks += measurement.ticks
+        self.segments += measurement.segments
+        self.events += measurement.events
+
+
+class PipelineMetrics:
+    """Thread-safe throughput and latency metrics of the data collection pipeline.
+
+    Every stage (download, extract, tick parsing, featurization, ...) records wall time, bytes, tick rows, segments
+    produced and game events, in total and for the most recent demos. Queue depths of the staged pipeline are tracked
+    as gauges.
+
+    Metrics recorded in worker processes are not sent back to the parent process.
+    """
+
+    def __init__(self, recent_calls: int = 1_000):
+        """Constructor.
+
+        :param recent_calls: number of most recent per-demo calls kept, so memory use and the size of snapshots don't
+                             grow with the number of demos. Stage totals cover every call.
+        """
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._stages: dict[str, StageStats] = {}
+        self._recent: deque[tuple[str, str, dict]] = deque(maxlen=recent_calls)
+        self._gauges: dict[str, float] = {}
+
+    def __reduce__(self):
+        # locks can't be pickled, e.g. when a parser holding metrics is sent to a worker process
+        return PipelineMetrics, ()
+
+    @contextmanager
+    def timed(self, stage: str, demo: str = None):
+        """Time a call of a stage.
+
+        The yielded measurement can be filled in with the bytes, ticks, segments and events handled by the call. If the call
+        raises, it is counted as an error of the stage.
+
+        :param stage: the stage name.
+        :param demo: the demo this call is working on, e.g. ``<match_id>/<map_id>``.
+        """
+        measurement = Measurement()
+        start = time.perf_counter()
+        error = False
+        try:
+            yield measurement
+        except BaseException:
+            error = True
+            raise
+        finally:
+            measurement.seconds = time.perf_counter() - start
+            self.record(stage, measurement, demo=demo, error=error)
+
+    def record(self, stage: str, measurement: Measurement, demo: str = None, error: bool = False):
+        """Record a call of a stage.
+
+        :param stage: the stage name.
+        :param measurement: what the call measured.
+        :param demo: the demo this call was working on.
+        :param error: whether the call failed.
+        """
+        with self._lock:
+            self._stages.setdefault(stage, StageStats()).add(measurement, error)
+            if demo is not None:
+                self._recent.append((demo, stage, {**asdict(measurement), "error": error}))
+
+    def set_gauge(self, name: str, value: float):
+        """Set a gauge, e.g. the depth of a queue."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self) -> dict:
+        """Get a JSON-serializable snapshot of all metrics."""
+        with self._lock:
+            uptime = time.time() - self._started
+            stages = {}
+            for name, stats in self._stages.items():
+                stages[name] = {
+                    **asdict(stats),
+                    "ticks_per_second": stats.ticks / stats.seconds if stats.seconds else 0.0,
+                    "bytes_per_second": stats.bytes / stats.seconds if stats.seconds else 0.0,
+                }
+            demos_parsed = self._stages.get("parse_demo", StageStats()).calls
+            demos = {}
+            for demo, stage, measurement in self._recent:
+                demos.setdefault(demo, {})[stage] = measurement
+            return {
+                "timestamp": time.time(),
+                "uptime_seconds": uptime,
+                "demos_parsed": demos_parsed,
+                "demos_per_hour": demos_parsed / uptime * 3600 if uptime else 0.0,
+                "stages": stages,
+                "gauges": dict(self._gauges),
+                "demos": demos,
+            }
+
+    def write_json(self, path: str):
+        """Write a JSON snapshot of the metrics."""
+        _write_atomic(path, json.dumps(self.snapshot(), indent=2))
+
+    def write_prometheus(self, path: str, prefix: str = "cs2_pipeline"):
+        """Write the metrics in the Prometheus text exposition format, for the node exporter's textfile collector.
+
+        Only totals are exported, rates (e.g. ticks/sec, demos/hour) are left to PromQL.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            f"# TYPE {prefix}_uptime_seconds gauge",
+            f"{prefix}_uptime_seconds {snapshot['uptime_seconds']:.3f}",
+        ]
+        for field in ["calls", "errors", "seconds", "bytes", "ticks", "segments", "events"]:
+            lines.append(f"# TYPE {prefix}_stage_{field}_total counter")
+            for stage, stats in snapshot["stages"].items():
+                lines.append(f'{prefix}_stage_{field}_total{{stage="{stage}"}} {stats[field]}')
+        lines.append(f"# TYPE {prefix}_gauge gauge")
+        for name, value in snapshot["gauges"].items():
+            lines.append(f'{prefix}_gauge{{name="{name}"}} {value}')
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+    def write(self, directory: str):
+        """Write both the JSON snapshot and the Prometheus textfile to the given directory."""
+        os.makedirs(directory, exist_ok=True)
+        self.write_json(os.path.join(directory, "metrics.json"))
+        self.write_prometheus(os.path.join(directory, "metrics.prom"))
+
+
+class MetricsReporter:
+    """Background thread that periodically writes metrics to disk."""
+
+    def __init__(self, metrics: PipelineMetrics, directory: str, interval: float = 30.0):
+        """Constructor.
+
+        :param metrics: the metrics to write.
+        :param directory: the directory to write ``metrics.json`` and ``metrics.prom`` to.
+        :param interval: seconds between two writes.
+        """
+        self._metrics = metrics
+        self._directory = directory
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._thread.join()
+        # final snapshot, so the totals of a finished run are always on disk
+        self._metrics.write(self._directory)
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self._metrics.write(self._directory)
+
+
+def _write_atomic(path: str, content: str):
+    # write to a temp file and rename, so readers never see a partially written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
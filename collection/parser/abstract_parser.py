@@ -1,6 +1,20 @@
 import logging
 import os
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Iterable
+
+from collection.metrics import PipelineMetrics
+
+
+@dataclass
+class DemoResult:
+    """Outcome of parsing a single .dem file."""
+    path: str
+    map_id: int
+    seconds: float
+    bytes: int
+    error: str = None
 
 
 class AbstractParser(ABC):
@@ -12,24 +26,70 @@ class AbstractParser(ABC):
         :param directory: directory where processed data and metadata are stored.
         """
         self._directory = os.path.abspath(directory)
+        self.metrics = PipelineMetrics()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Release resources held by the parser, e.g. worker processes."""
+        pass
+
+    @property
+    def directory(self) -> str:
+        return self._directory
 
-    def parse_directory(self, directory: str, match_id: str):
+    def parse_directory(self, directory: str, match_id: str) -> list[DemoResult]:
         """Parse .dem files within the given directory.
 
+        A demo that fails to parse does not stop the remaining demos from being parsed, the failure is reported in the
+        returned results instead.
+
         :param directory: the directory that contains all .dem files to parse. Traversed recursively.
         :param match_id: the match ID which is associated with the given .dem files.
+        :return: the outcome of every .dem file found.
+        """
+        paths = (
+            os.path.join(root, file)
+            for root, _, files in os.walk(directory)
+            for file in files
+            if file.endswith(".dem")
+        )
+        return self.parse_paths(paths, match_id=match_id)
+
+    def parse_paths(self, paths: Iterable[str], match_id: str) -> list[DemoResult]:
+        """Parse the given .dem files, in order.
+
+        The paths are consumed lazily, so they may be produced while parsing (e.g. extracted from an archive one at a
+        time).
+
+        :param paths: the .dem files to parse.
+        :param match_id: the match ID which is associated with the given .dem files.
+        :return: the outcome of every .dem file.
+        """
+        return [self.parse_path(path, match_id=match_id, map_id=map_id) for map_id, path in enumerate(paths)]
+
+    def parse_path(self, path: str, match_id: str, map_id: int) -> DemoResult:
+        """Parse a single .dem file, reporting failure in the result instead of raising.
+
+        :param path: the .dem file to parse.
+        :param match_id: the match ID for this .dem file.
+        :param map_id: the map ID for this .dem file.
+        :return: the outcome of parsing the .dem file.
         """
-        map_id = 0
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if file.endswith(".dem"):
-                    path = os.path.join(root, file)
-                    try:
-                        logging.info(f"parsing {path}")
-                        self.parse_demo(path, match_id=match_id, map_id=map_id)
-                        map_id += 1
-                    except Exception as e:
-                        logging.error(f"could not parse {path} - {e}")
+        error = None
+        try:
+            with self.metrics.timed("parse_demo", demo=f"{match_id}/{map_id}") as measurement:
+                measurement.bytes = os.path.getsize(path)
+                logging.info(f"parsing {path}")
+                self.parse_demo(path, match_id=match_id, map_id=map_id)
+        except Exception as e:
+            logging.error(f"could not parse {path} - {e}")
+            error = str(e)
+        return DemoResult(path, map_id, measurement.seconds, measurement.bytes, error)
 
     @abstractmethod
     def parse_demo(self, path: str, match_id: str, map_id: int):
@@ -40,24 +100,3 @@ class AbstractParser(ABC):
         :param map_id: the generic map ID for this .dem file. Not guaranteed to align with order of maps played.
         """
         pass
-
-    def parsed(self, match_id: str):
-        """Return where the given match was parsed.
-
-        :param match_id: the match ID.
-        :return: True if the match was parsed already, False otherwise.
-        """
-        parsed_directory = os.path.join(self._directory, ".parsed")
-        os.makedirs(parsed_directory, exist_ok=True)
-        flagpath = os.path.join(parsed_directory, match_id)
-        return os.path.exists(flagpath)
-
-    def mark_parsed(self, match_id: str):
-        """Mark this match as parsed.
-
-        :param match_id: the match ID.
-        """
-        parsed_directory = os.path.join(self._directory, ".parsed")
-        os.makedirs(parsed_directory, exist_ok=True)
-        flagpath = os.path.join(parsed_directory, match_id)
-        open(flagpath, "a").close()
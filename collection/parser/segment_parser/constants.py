@@ -1,2 +1,13 @@
+import polars as pl
+
 KEY_FEATURES = ["FORWARD", "LEFT", "RIGHT", "BACK", "FIRE", "is_walking"]
 MOUSE_FEATURES = ["yaw", "pitch"]
+
+# compact types of the tick data
+TICK_DTYPES = {
+    "tick": pl.UInt32,
+    "round": pl.UInt16,
+    "team_num": pl.UInt8,
+    **{key: pl.UInt8 for key in KEY_FEATURES},
+    **{feature: pl.Float32 for feature in MOUSE_FEATURES},
+}
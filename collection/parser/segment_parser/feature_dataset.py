@@ -0,0 +1,111 @@
+import glob
+import os
+import threading
+
+import polars as pl
+
+# types of the partition columns, which are parsed from the directory names
+PARTITION_SCHEMA = {"stride": pl.UInt16, "segment_length": pl.UInt16, "match_id": pl.String, "map_id": pl.UInt8}
+
+
+class FeatureDataset:
+    """Hive-partitioned Parquet dataset of segment features, an alternative to one CSV file per player and map.
+
+    The features of all players of a demo are stored in a single file at
+    ``<directory>/stride=<seconds>/segment_length=<seconds>/match_id=<match_id>/map_id=<map_id>/features.parquet``,
+    sorted by steam ID (a column), with float features stored as Float32. The stride of non-overlapping segments is 0,
+    so sliding windows and segments of the same length never share a partition. The whole dataset is loaded with a
+    single lazy scan, see ``scan_features``.
+    """
+
+    def __init__(self, directory: str, compression_level: int = 3, row_group_size: int = 16_384):
+        """Constructor.
+
+        :param directory: the dataset directory.
+        :param compression_level: zstd compression level.
+        :param row_group_size: max number of segments per row group. Every row group has column statistics, so scans
+                               filtering on e.g. ``steamid`` or ``team_num`` can skip row groups.
+        """
+        self._directory = os.path.abspath(directory)
+        self._compression_level = compression_level
+        self._row_group_size = row_group_size
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    def path(self, segment_length: int, match_id: str, map_id: int, stride: int = None) -> str:
+        """Get the path of the features of a demo."""
+        return os.path.join(
+            self._directory,
+            f"stride={stride or 0}",
+            f"segment_length={segment_length}",
+            f"match_id={match_id}",
+            f"map_id={map_id}",
+            "features.parquet",
+        )
+
+    def put(self, features: pl.DataFrame, segment_length: int, match_id: str, map_id: int, stride: int = None) -> int:
+        """Store the features of all players of a demo, replacing any stored version.
+
+        :param features: the segment features of every player, as produced by ``SegmentParser``, with their steam ID
+                         in a ``steamid`` column.
+        :param segment_length: the segment length, in seconds.
+        :param match_id: the match ID.
+        :param map_id: the map ID.
+        :param stride: the stride of sliding windows, in seconds, or None for non-overlapping segments.
+        :return: size of the stored file, in bytes.
+        """
+        features = features.select([
+            pl.col("steamid").cast(pl.UInt64),
+            pl.all().exclude(["steamid", "team_num"]),
+            pl.col("team_num").cast(pl.UInt8),
+        ]).sort(["steamid", "segment_id"])
+        features = features.cast({column: pl.Float32 for column in features.select(pl.col(pl.Float64)).columns})
+
+        path = self.path(segment_length, match_id, map_id, stride)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file and rename, so a crash never leaves a truncated file in the dataset
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        features.write_parquet(
+            tmp_path,
+            compression="zstd",
+            compression_level=self._compression_level,
+            statistics=True,
+            row_group_size=self._row_group_size,
+        )
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+
+def scan_features(directory: str, stride: int = None, segment_length: int = None) -> pl.LazyFrame:
+    """Lazily scan a feature dataset written by ``FeatureDataset``.
+
+    Segments (stride 0) and sliding windows have different feature columns, so every (stride, segment length)
+    partition is scanned on its own. A scan over both has the columns of both, with nulls where a partition lacks a
+    column, so select a stride to only get the columns of its features.
+
+    Filters on the partition columns (``stride``, ``segment_length``, ``match_id``, ``map_id``) skip whole
+    directories, e.g. ``scan_features(directory, stride=0).filter(pl.col("match_id") == "2370000")``.
+
+    :param directory: the dataset directory.
+    :param stride: if given, only scan the features with this stride, in seconds (0 for non-overlapping segments).
+    :param segment_length: if given, only scan the features of this segment length, in seconds.
+    :return: the features of all players, with the partition columns.
+    """
+    partitions = sorted(glob.glob(os.path.join(
+        glob.escape(directory),
+        f"stride={'*' if stride is None else stride}",
+        f"segment_length={'*' if segment_length is None else segment_length}",
+    )))
+    if not partitions:
+        raise FileNotFoundError(f"no features in {directory} (stride={stride}, segment_length={segment_length})")
+    scans = [
+        pl.scan_parquet(
+            os.path.join(glob.escape(partition), "**", "*.parquet"),
+            hive_partitioning=True,
+            hive_schema=PARTITION_SCHEMA,
+        )
+        for partition in partitions
+    ]
+    return pl.concat(scans, how="diagonal")
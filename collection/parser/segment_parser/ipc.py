@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+import polars as pl
+
+# tmpfs when available, so shared frames never touch the disk
+SHARED_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+def write_shared(df: pl.DataFrame) -> str:
+    """Write a DataFrame to an uncompressed Arrow IPC file in shared memory.
+
+    Other processes can then map the file instead of receiving a pickled copy of the DataFrame.
+
+    :param df: the DataFrame.
+    :return: the path of the IPC file. The caller is responsible for removing it.
+    """
+    fd, path = tempfile.mkstemp(prefix="cs2-", suffix=".arrow", dir=SHARED_DIRECTORY)
+    os.close(fd)
+    try:
+        df.write_ipc(path, compression="uncompressed")
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def read_shared(path: str) -> pl.DataFrame:
+    """Memory-map a DataFrame written by ``write_shared``, without copying its buffers.
+
+    The file can be removed once it is mapped, the mapping stays valid until the DataFrame is dropped.
+
+    :param path: the path of the IPC file.
+    :return: the DataFrame.
+    """
+    return pl.read_ipc(path, memory_map=True)
@@ -1,98 +1,68 @@
-from collections import Counter
-from itertools import pairwise
-
-import numpy as np
 import polars as pl
 
 from collection.parser.segment_parser.constants import KEY_FEATURES
 
 
-def extract_entropy(segmented_player_df: pl.DataFrame) -> pl.Series:
-    """Compute the Shannon entropy for bigram sequence of key presses.
+def aggregate_entropy(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    """Build the lazy query of the Shannon entropy for bigram sequence of key presses.
+
+    Bigrams are taken over consecutive key presses within a segment, and their probabilities over all segments of the
+    player. The entropy of a segment sums -p(x)*log(p(x)) over every bigram x occurring in it.
 
-    :param segmented_player_df:
-    :return:
+    Segments without bigrams are missing, their entropy is 0.
+
+    :param ticks: segmented player ticks.
+    :return: the entropy of each segment with at least one bigram.
     """
-    # extract N key presses per tick
-    key_presses_df = extract_key_presses(segmented_player_df)
+    return compute_entropy(extract_bigrams(extract_key_presses(ticks)))
 
-    # create bigrams
-    bigrams_df = (
-        key_presses_df.with_columns(
-            pl.col("presses")
-            .map_elements(lambda presses: (
-                [f"{a}->{b}" for a, b in pairwise(presses)] if not presses.is_empty() else []
-            ), return_dtype=pl.List(pl.Utf8))
-            .alias("bigrams")
-        )
-    )
 
-    bigram_frequency_distribution = compute_bigram_frequency_distribution(bigrams_df)
-    entropy = compute_entropy(bigrams_df, bigram_frequency_distribution)
-    return entropy
+def extract_key_presses(segmented_player_df: pl.LazyFrame) -> pl.LazyFrame:
+    """Extract the sequence of key presses of each segment.
 
+    Keys are encoded by their index in ``KEY_FEATURES``. Presses in the same tick are ordered by key index.
 
-def extract_key_presses(segmented_player_df: pl.DataFrame) -> pl.DataFrame:
-    key_presses = (
-        segmented_player_df
-        # detect rising edges
-        .with_columns([
-            ((pl.col(key).shift().over("segment_id").fill_null(0) == 0) & (pl.col(key) == 1))
-            .alias(f"{key}_rising_edge")
-            for key in KEY_FEATURES
-        ])
-        # select key presses when rising edge occurs
-        .select(["segment_id"] + [
-            pl.when(pl.col(f"{key}_rising_edge"))
-                .then(pl.lit(key))
-                .otherwise(pl.lit(None))
-                .alias(f"{key}_event")
-            for key in KEY_FEATURES
-        ])
-        # group by segment ID
-        .group_by("segment_id")
-        .agg([
-            # concatenate rows together that have non-null key presses (i.e. rising edge)
-            pl.concat_list([
-                pl.col(f"{key}_event") for key in KEY_FEATURES
-            ])
-            .list.explode()  # flatten nested lists (list[list[str]] → list[str])
-            .drop_nulls()
-            .alias("presses")
+    :param segmented_player_df: player ticks, in segments.
+    :return: one row per key press, with the segment ID and key code, in order of the press.
+    """
+    ticks = segmented_player_df.select("segment_id", *KEY_FEATURES).with_row_index("index")
+    return (
+        pl.concat([
+            ticks
+            # detect rising edges
+            .filter((pl.col(key).shift().over("segment_id").fill_null(0) == 0) & (pl.col(key) == 1))
+            .select("index", "segment_id", pl.lit(code, dtype=pl.UInt8).alias("key"))
+            for code, key in enumerate(KEY_FEATURES)
         ])
-        .sort("segment_id")
+        .sort(["index", "key"])
+        .drop("index")
     )
-    return key_presses
 
 
-def compute_bigram_frequency_distribution(bigrams_df: pl.DataFrame) -> Counter:
-    bigram_frequency_distribution = Counter(
-        bigrams_df
-        .select("bigrams")
-        .to_series()
-        .explode()
-        .drop_nulls()
-        .to_list()
+def extract_bigrams(key_presses: pl.LazyFrame) -> pl.LazyFrame:
+    """Pair up consecutive key presses within each segment.
+
+    :param key_presses: key presses, in order.
+    :return: one row per bigram, with the segment ID and bigram code ``first * len(KEY_FEATURES) + second``.
+    """
+    return (
+        key_presses
+        .with_columns(
+            (pl.col("key").shift().over("segment_id").cast(pl.UInt16) * len(KEY_FEATURES) + pl.col("key"))
+            .alias("bigram")
+        )
+        .drop_nulls("bigram")
+        .select("segment_id", "bigram")
     )
-    return bigram_frequency_distribution
 
 
-def compute_entropy(bigrams_df: pl.DataFrame, bigram_frequency_distribution: Counter) -> pl.Series:
+def compute_entropy(bigrams: pl.LazyFrame) -> pl.LazyFrame:
     # compute shannon entropy
     # -sum(p(x)*log(p(x))
-    n_bigrams = sum(bigram_frequency_distribution.values())
-    entropy = (
-        bigrams_df
-        .select("bigrams")
-        .to_series()
-        .map_elements(
-            lambda xs: -sum(
-                bigram_frequency_distribution[x] / n_bigrams
-                * np.log(bigram_frequency_distribution[x] / n_bigrams)
-                for x in xs
-            ),
-            return_dtype=pl.Float32
-        )
-        .alias("entropy")
+    p = pl.len().over("bigram") / pl.len()
+    return (
+        bigrams
+        .with_columns((-(p * p.log())).alias("entropy"))
+        .group_by("segment_id")
+        .agg(pl.sum("entropy").cast(pl.Float32))
     )
-    return entropy
@@ -3,20 +3,22 @@ import polars as pl
 from collection.parser.segment_parser.constants import KEY_FEATURES
 
 
-def extract_n_key_presses(segmented_player_df: pl.DataFrame) -> pl.DataFrame:
-    features = (
-        segmented_player_df
-        .with_columns([
-            ((pl.col(key).shift() == 0) & (pl.col(key) == 1)).alias(f"{key}_presses").fill_null(False).cast(pl.UInt32)
-            for key in KEY_FEATURES
-        ])
-        .group_by("segment_id")
-        .agg(
-            pl.col([f"{key}_presses" for key in KEY_FEATURES]).sum(),
-        )
-        .sort("segment_id")
-        .with_columns(
-            pl.sum_horizontal([f"{key}_presses" for key in KEY_FEATURES]).alias("total_presses")
-        )
-    )
-    return features
+def n_key_presses_columns() -> list[pl.Expr]:
+    """Tick-level columns the n_key_presses aggregations depend on: whether each key was pressed at each tick."""
+    return [
+        ((pl.col(key).shift() == 0) & (pl.col(key) == 1)).fill_null(False).cast(pl.UInt32).alias(f"{key}_presses")
+        for key in KEY_FEATURES
+    ]
+
+
+def n_key_presses_aggregations() -> list[pl.Expr]:
+    """Count the number of presses of each key during each segment.
+
+    :return: segment-level aggregations, one column per key.
+    """
+    return [pl.col([f"{key}_presses" for key in KEY_FEATURES]).sum()]
+
+
+def total_presses() -> pl.Expr:
+    """Sum the key presses of all keys, from the aggregated presses of each key."""
+    return pl.sum_horizontal([f"{key}_presses" for key in KEY_FEATURES]).alias("total_presses")
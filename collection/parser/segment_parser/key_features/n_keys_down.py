@@ -3,51 +3,36 @@ import polars as pl
 from collection.parser.segment_parser.constants import KEY_FEATURES
 
 
-def extract_n_keys_down(segmented_player_df: pl.DataFrame) -> pl.DataFrame:
+def n_keys_down_columns() -> list[pl.Expr]:
+    """Tick-level columns the n_keys_down aggregations depend on: the number of keys held down at each tick."""
+    return [pl.sum_horizontal(KEY_FEATURES).alias("n_keys")]
+
+
+def n_keys_down_aggregations() -> list[pl.Expr]:
     """Extract the distribution of time that N keys are being held down during each segment.
 
     For example, if no keys are held down during an entire segment, then the feature vector will be [1 0 0 0 ... k]
     for K keys. If most of the time players only hold 1-3 keys, then these will be the most populous indices.
 
-    :param segmented_player_df:
-    :return: n_keys distribution feature dataframe.
+    :return: segment-level aggregations, one column per number of keys.
+    """
+    return [
+        ((pl.col("n_keys") == n).sum() / pl.len()).alias(f"keys_down_{n}")
+        for n in range(0, len(KEY_FEATURES) + 1)
+    ]
+
+
+def cast_unseen_n_keys_down(features: pl.DataFrame) -> pl.DataFrame:
+    """Make the columns of key counts the player never held down integer zeros.
+
+    This keeps the feature files identical to when the distribution was pivoted, where these columns were missing and
+    added as integer literals.
+
+    :param features: features, possibly with some of the n_keys_down columns.
+    :return: the features, with unseen key counts cast to integers.
     """
-    key_df = segmented_player_df.select([*KEY_FEATURES, "segment_id"])
-
-    features = (
-        key_df
-        .with_columns(
-            pl.sum_horizontal(KEY_FEATURES).alias("n_keys"),
-        )
-        .group_by("segment_id", "n_keys")
-        .agg(
-            pl.count().alias("count")
-        )
-        .with_columns(
-            (pl.col("count") / pl.col("count").sum().over("segment_id")).alias("normalized_count")
-        )
-        .pivot(
-            values="normalized_count",
-            index="segment_id",
-            columns="n_keys",
-            aggregate_function="first"
-        )
-        .fill_null(0)
-    )
-    # add missing columns (e.g. if not all 6 buttons are pressed)
-    n_values = [str(n) for n in range(0, len(KEY_FEATURES) + 1)]
-    features = (
-        features
-        .with_columns([
-            pl.lit(0).alias(col) for col in n_values if col not in features.columns
-        ])
-        .rename({str(i): f"keys_down_{i}" for i in range(0, len(KEY_FEATURES) + 1)})
-        .fill_null(0)
-        .sort("segment_id")
-    )
-    # sort columns
-    features = (
-        features
-        .select(sorted(features.columns))
-    )
-    return features
+    unseen = [
+        f"keys_down_{n}" for n in range(0, len(KEY_FEATURES) + 1)
+        if f"keys_down_{n}" in features.columns and not (features[f"keys_down_{n}"] > 0).any()
+    ]
+    return features.with_columns([pl.col(col).cast(pl.Int32) for col in unseen])
@@ -0,0 +1,81 @@
+import polars as pl
+
+from collection.parser.segment_parser.constants import KEY_FEATURES
+
+
+def extract_key_runs(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    """Run-length encode the state of all keys in a single pass.
+
+    A run is a stretch of consecutive ticks with a key held down. Runs are split at segment boundaries (and so at round
+    boundaries too), so every run belongs to exactly one segment.
+
+    :param ticks: segmented player ticks.
+    :return: one row per run, with the key, segment ID, start (row index within the player) and length (in ticks).
+             Runs are ordered by key, then start.
+    """
+    down = pl.col("down") == 1
+    # a tick continues the run of the previous row if both are down, for the same key and in the same segment
+    continues = (
+        down.shift()
+        & (pl.col("key") == pl.col("key").shift())
+        & (pl.col("segment_id") == pl.col("segment_id").shift())
+    ).fill_null(False)
+    return (
+        ticks
+        .select(["segment_id", *KEY_FEATURES])
+        .with_row_index("index")
+        # one row per (tick, key), all ticks of the first key come first
+        .unpivot(on=KEY_FEATURES, index=["index", "segment_id"], variable_name="key", value_name="down")
+        .with_columns([
+            pl.col("index").cast(pl.Int64),
+            pl.col("key").cast(pl.Enum(KEY_FEATURES)),
+        ])
+        .with_columns((down & continues.not_()).cum_sum().alias("run"))
+        .filter(down)
+        .group_by("run", maintain_order=True)
+        .agg([
+            pl.first("key"),
+            pl.first("segment_id"),
+            pl.first("index").alias("start"),
+            pl.len().alias("length"),
+        ])
+        .drop("run")
+    )
+
+
+def aggregate_key_runs(runs: pl.LazyFrame) -> pl.LazyFrame:
+    """Compute the key down time and transition time statistics of each segment from the key runs.
+
+    The down time of a press is the length of its run. The transition time is the number of ticks from the end of a
+    run to the start of the next run of the same key, within the same segment. Statistics are (min, max, mean, std,
+    count), where the count of down times is the number of presses.
+
+    :param runs: the key runs, ordered by key, then start.
+    :return: the statistics for every key, for each segment with at least one run.
+    """
+    same_key_next = (pl.col("key") == pl.col("key").shift(-1)) & (pl.col("segment_id") == pl.col("segment_id").shift(-1))
+    end = pl.col("start") + pl.col("length") - 1
+    return (
+        runs
+        .with_columns(
+            pl.when(same_key_next).then(pl.col("start").shift(-1) - end).otherwise(None).alias("transition")
+        )
+        .group_by("segment_id")
+        .agg([
+            *[expr for key in KEY_FEATURES for expr in _stats("transition", key)],
+            *[expr for key in KEY_FEATURES for expr in _stats("length", key, name="duration")],
+        ])
+    )
+
+
+def _stats(column: str, key: str, name: str = None) -> list[pl.Expr]:
+    # (min, max, mean, std, count) of the runs of one key
+    name = name or column
+    values = pl.col(column).filter(pl.col("key") == key)
+    return [
+        values.min().alias(f"min_{key}_{name}"),
+        values.max().alias(f"max_{key}_{name}"),
+        values.mean().alias(f"mean_{key}_{name}"),
+        values.std().alias(f"std_{key}_{name}"),
+        values.count().alias(f"sum_{key}_{name}"),
+    ]
@@ -1,48 +1,30 @@
 import polars as pl
 
-from collection.parser.segment_parser.mouse_features.count import extract_count
-from collection.parser.segment_parser.mouse_features.duration import extract_duration
-from collection.parser.segment_parser.mouse_features.speed import extract_speed
-from collection.parser.segment_parser.mouse_features.straight_distance import extract_straight_distance
-from collection.parser.segment_parser.mouse_features.total_distance import extract_total_distance
+SPEED_FEATURES = ["yaw_speed", "pitch_speed", "yaw_speed_acc", "pitch_speed_acc"]
 
 
-def extract(segmented_player_df: pl.DataFrame) -> pl.DataFrame:
-    """Extract mouse features from the segmented player DataFrame.
+def aggregate(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    """Build the lazy query of the mouse features of each segment.
 
-    :param segmented_player_df: player DataFrame, in segments.
+    Every mouse movement is aggregated once, and all statistics (count, total distance, straight distance, duration,
+    speed) are computed from these movement aggregates.
+
+    Segments without any mouse data are missing, join the result onto ``segment_ids`` to fill them in.
+
+    :param ticks: segmented player ticks.
     :return: mouse features for each segment.
     """
-    mouse_df = segmented_player_df.select(["yaw", "pitch", "segment_id"])
-    mouse_df = extract_velocity_and_acceleration(mouse_df)
-    mouse_df = extract_mouse_movements(mouse_df)
+    mouse = extract_mouse_movements(extract_velocity_and_acceleration(ticks.select(["yaw", "pitch", "segment_id"])))
+    return aggregate_segments(aggregate_movements(mouse))
 
-    # extract stats on mouse movements
-    count_df = extract_count(mouse_df)
-    # (mean, std, min, max, sum)
-    total_distance_df = extract_total_distance(mouse_df)
-    straight_distance_df = extract_straight_distance(mouse_df)
-    duration_df = extract_duration(mouse_df)
-    speed_df = extract_speed(mouse_df)
-
-    features = (
-        count_df
-        .join(total_distance_df, on="segment_id", how="inner")
-        .join(straight_distance_df, on="segment_id", how="inner")
-        .join(duration_df, on="segment_id", how="inner")
-        .join(speed_df, on="segment_id", how="inner")
-    )
-    return features
 
-
-def extract_velocity_and_acceleration(mouse_df: pl.DataFrame) -> pl.DataFrame:
+def extract_velocity_and_acceleration(mouse_df: pl.LazyFrame) -> pl.LazyFrame:
     """Extract the angular velocity and acceleration from the given mouse data.
 
-    :param mouse_df: DataFrame containing yaw, pitch at each tick.
-    :return: DataFrame with appended columns containing velocity and acceleration.
+    :param mouse_df: yaw, pitch at each tick.
+    :return: mouse data with appended columns containing velocity and acceleration.
     """
-
-    df = (
+    return (
         mouse_df
         .with_columns([
             pl.col("pitch").diff().fill_null(0).alias("pitch_delta"),
@@ -52,56 +34,146 @@ def extract_velocity_and_acceleration(mouse_df: pl.DataFrame) -> pl.DataFrame:
             # handle circular wrapping
             (((pl.col("yaw_delta") + 180) % 360) - 180).alias("yaw_delta"),
         )
-        .with_columns(
-            (pl.col("yaw_delta").pow(2) + pl.col("pitch_delta").pow(2)).sqrt()
-            .alias("angular_displacement")
-        )
+        .with_columns([
+            (pl.col("yaw_delta").pow(2) + pl.col("pitch_delta").pow(2)).sqrt().alias("angular_displacement"),
+            pl.col("yaw_delta").abs().alias("yaw_speed"),
+            pl.col("pitch_delta").abs().alias("pitch_speed"),
+        ])
+        .with_columns([
+            pl.col("yaw_speed").diff().fill_null(0).alias("yaw_speed_acc"),
+            pl.col("pitch_speed").diff().fill_null(0).alias("pitch_speed_acc"),
+        ])
     )
-    return df
 
 
-def extract_mouse_movements(mouse_df: pl.DataFrame, at_rest_threshold=0.01) -> pl.DataFrame:
+def extract_mouse_movements(mouse_df: pl.LazyFrame, at_rest_threshold=0.01) -> pl.LazyFrame:
     """Identify individual mouse movements within the given mouse data.
 
-    Three new columns are appended to the returned dataframe:
-        - `at_rest`: binary 1 or 0 if the mouse is at rest (computed from tangential velocity).
-        - `movement_start`: binary 1 or 0 to detect when `at_rest` transitions from 1->0.
-        - `mouse_movement_id`: assigns a unique identifier to each separate mouse movement.
-                               ticks when mouse is at rest have `null` identifiers.
+    The `mouse_movement_id` column is appended, numbering the movements within each segment. Ticks when the mouse is
+    at rest (its angular displacement is at most the threshold) have `null` identifiers.
 
-    :param mouse_df:
+    :param mouse_df: mouse data with angular displacement.
     :param at_rest_threshold: the maximum velocity for a mouse to be considered "at rest".
-    :return: DataFrame with appended columns containing mouse movement identifier.
+    :return: mouse data with appended column containing mouse movement identifier.
     """
-    df = (
+    at_rest = pl.col("angular_displacement") <= at_rest_threshold
+    return (
         mouse_df
-        # append new column `at_rest` to see when mouse is not in motion
-        .with_columns(
-            (pl.col("angular_displacement") <= at_rest_threshold).cast(pl.Int32()).alias("at_rest")
-        )
-        # identify when `at_rest` transitions 1->0 (a new movement starts)
-        .with_columns(
-            ((pl.col("at_rest").shift(1).fill_null(1) == 0) & (pl.col("at_rest") == 1))
-            .cast(pl.Int32())
-            .alias("movement_start")
-        )
-        # create `mouse_movement_id` by cumulatively summing movement_start and filling forward
         .with_columns(
-            pl.col("movement_start")
+            # bump the movement ID whenever the mouse comes to rest, counting up within each segment
+            (at_rest.shift(1).fill_null(True).not_() & at_rest)
+            .cast(pl.Int32)
             .cum_sum()
             .over("segment_id")
             .alias("mouse_movement_id")
         )
         .with_columns(
-            pl.when(pl.col("at_rest") == 0)
-            .then(pl.col("mouse_movement_id"))
-            .otherwise(None)
-            .alias("mouse_movement_id")
+            pl.when(at_rest.not_()).then(pl.col("mouse_movement_id")).otherwise(None).alias("mouse_movement_id")
         )
-        # create global movement_id across segments
+    )
+
+
+def aggregate_movements(mouse_df: pl.LazyFrame) -> pl.LazyFrame:
+    """Aggregate the ticks of every mouse movement.
+
+    All ticks at rest are aggregated as one more pseudo-movement (flagged ``is_rest``), attributed to the first segment
+    with a tick at rest. It counts towards distance and speed statistics, but not towards movement count and duration,
+    the way these features have always been computed.
+
+    :param mouse_df: mouse data with movement identifiers.
+    :return: one row per movement.
+    """
+    return pl.concat([aggregate_moving(mouse_df), aggregate_rest(mouse_df)])
+
+
+def aggregate_moving(mouse_df: pl.LazyFrame) -> pl.LazyFrame:
+    """Aggregate the ticks of every mouse movement, leaving out the ticks at rest.
+
+    :param mouse_df: mouse data with movement identifiers.
+    :return: one row per movement.
+    """
+    aggregations = _movement_aggregations()
+    return (
+        mouse_df
+        .filter(pl.col("mouse_movement_id").is_not_null())
+        .group_by(["segment_id", "mouse_movement_id"])
+        .agg(aggregations)
+        .select(["segment_id", pl.lit(False).alias("is_rest"), *[expr.meta.output_name() for expr in aggregations]])
+    )
+
+
+def aggregate_rest(mouse_df: pl.LazyFrame) -> pl.LazyFrame:
+    """Aggregate all ticks at rest into the pseudo-movement described in ``aggregate_movements``.
+
+    :param mouse_df: mouse data with movement identifiers.
+    :return: a single row, or none if the mouse never rests.
+    """
+    return (
+        mouse_df
+        .filter(pl.col("mouse_movement_id").is_null())
+        .select([pl.first("segment_id"), pl.lit(True).alias("is_rest"), *_movement_aggregations()])
+        # a player whose mouse never rests has no pseudo-movement
+        .filter(pl.col("segment_id").is_not_null())
+    )
+
+
+def _movement_aggregations() -> list[pl.Expr]:
+    return [
+        pl.len().alias("n_ticks"),
+        pl.sum("angular_displacement").alias("total_distance"),
+        pl.first("yaw").alias("yaw_start"),
+        pl.first("pitch").alias("pitch_start"),
+        pl.last("yaw").alias("yaw_end"),
+        pl.last("pitch").alias("pitch_end"),
+        *[pl.mean(feature).alias(f"mean_{feature}") for feature in SPEED_FEATURES],
+        *[pl.std(feature).alias(f"std_{feature}") for feature in SPEED_FEATURES],
+        *[pl.min(feature).alias(f"min_{feature}") for feature in SPEED_FEATURES],
+        *[pl.max(feature).alias(f"max_{feature}") for feature in SPEED_FEATURES],
+    ]
+
+
+def aggregate_segments(movements: pl.LazyFrame) -> pl.LazyFrame:
+    """Aggregate the movements of every segment into the mouse features.
+
+    :param movements: the movement aggregates.
+    :return: mouse features for each segment.
+    """
+    moving = pl.col("is_rest").not_()
+    return (
+        movements
+        .with_columns([
+            (pl.col("yaw_end") - pl.col("yaw_start")).alias("yaw_delta"),
+            (pl.col("pitch_end") - pl.col("pitch_start")).alias("pitch_delta"),
+            (pl.col("n_ticks") / 64).alias("duration"),  # 64Hz => 64 ticks per second
+        ])
         .with_columns(
-            (pl.col("segment_id").cast(pl.Utf8) + "_" + pl.col("mouse_movement_id").cast(pl.Utf8))
-            .alias("mouse_movement_id")
+            # correct for yaw wrapping [-180, 179)
+            ((pl.col("yaw_delta") + 180) % 360 - 180).alias("yaw_delta"),
         )
+        .with_columns(
+            # Euclidean distance between the start and end point of the movement
+            (pl.col("yaw_delta").pow(2) + pl.col("pitch_delta").pow(2)).sqrt().alias("straight_distance")
+        )
+        .group_by("segment_id")
+        .agg([
+            moving.sum().alias("n_mouse_movements"),
+            *_stats(pl.col("total_distance"), "total_distance"),
+            *_stats(pl.col("straight_distance"), "straight_distance"),
+            *_stats(pl.col("duration").filter(moving), "duration"),
+            *[pl.mean(f"mean_{feature}") for feature in SPEED_FEATURES],
+            *[pl.std(f"std_{feature}") for feature in SPEED_FEATURES],
+            *[pl.min(f"min_{feature}") for feature in SPEED_FEATURES],
+            *[pl.max(f"max_{feature}") for feature in SPEED_FEATURES],
+        ])
     )
-    return df
+
+
+def _stats(expr: pl.Expr, name: str) -> list[pl.Expr]:
+    # (mean, std, min, max, sum)
+    return [
+        expr.mean().alias(f"mean_{name}"),
+        expr.std().alias(f"std_{name}"),
+        expr.min().alias(f"min_{name}"),
+        expr.max().alias(f"max_{name}"),
+        expr.sum().alias(f"sum_{name}"),
+    ]
@@ -0,0 +1,251 @@
+import math
+from dataclasses import dataclass
+
+import polars as pl
+
+from collection.parser.segment_parser import key_features
+from collection.parser.segment_parser.constants import KEY_FEATURES
+from collection.parser.segment_parser.key_features.entropy import compute_entropy, extract_bigrams
+from collection.parser.segment_parser.key_features.n_key_presses import n_key_presses_columns, total_presses
+from collection.parser.segment_parser.key_features.n_keys_down import n_keys_down_columns
+from collection.parser.segment_parser.key_features.runs import aggregate_key_runs, extract_key_runs
+from collection.parser.segment_parser.mouse_features.main import (
+    SPEED_FEATURES,
+    aggregate_rest,
+    aggregate_segments,
+    extract_mouse_movements,
+    extract_velocity_and_acceleration,
+)
+from collection.parser.segment_parser.util import segment_player_df
+
+
+@dataclass
+class Partials:
+    """Mergeable partial aggregates of a player's ticks, over segments of a base length.
+
+    Every table is keyed by the base ``segment_id``. Mouse movements and key runs are cut into pieces at base segment
+    boundaries, and the pieces are merged back when they end up in the same coarser segment.
+    """
+    segments: pl.DataFrame  # tick counts, n_keys_down counts and key press counts of every base segment
+    teams: pl.DataFrame  # (segment_id, team_num) pairs
+    movements: pl.DataFrame  # mouse movement pieces, with sums, sums of squares, min and max of the speed features
+    rest: pl.DataFrame  # the rest pseudo-movement, see ``mouse_features.aggregate_movements``
+    runs: pl.DataFrame  # key run pieces
+    presses: pl.DataFrame  # key presses within base segments, flagged if the key was already held in the prior tick
+
+
+def extract_features(player_df: pl.DataFrame, segment_lengths: list[int]) -> dict[int, pl.DataFrame]:
+    """Extract features of a player at several segment lengths, in a single pass over the ticks.
+
+    Partial aggregates are computed once, over segments of the greatest common divisor of the segment lengths, and then
+    combined into each segment length. Features are the same as extracting each segment length separately.
+
+    :param player_df: the player tick information.
+    :param segment_lengths: the segment lengths, in ticks.
+    :return: the features for each segment length.
+    """
+    base_length = math.gcd(*segment_lengths)
+    partials = extract_partials(player_df, base_length)
+    return {length: combine(partials, length // base_length) for length in segment_lengths}
+
+
+def extract_partials(player_df: pl.DataFrame, base_length: int) -> Partials:
+    """Compute the partial aggregates of a player's ticks.
+
+    :param player_df: the player tick information.
+    :param base_length: the base segment length, in ticks.
+    :return: the partial aggregates.
+    """
+    ticks = segment_player_df(player_df, base_length).lazy().with_row_index("index")
+    ticks = ticks.with_columns(pl.col("index").cast(pl.Int64))
+
+    segments = (
+        ticks
+        .with_columns([*n_keys_down_columns(), *n_key_presses_columns()])
+        .group_by("segment_id")
+        .agg([
+            pl.len().alias("n_ticks"),
+            pl.min("index").alias("start"),
+            *[(pl.col("n_keys") == n).sum().alias(f"keys_down_{n}") for n in range(0, len(KEY_FEATURES) + 1)],
+            pl.col([f"{key}_presses" for key in KEY_FEATURES]).sum(),
+        ])
+    )
+    teams = ticks.select(["segment_id", "team_num"]).unique()
+
+    mouse = ticks.select(["index", "yaw", "pitch", "segment_id"])
+    mouse = extract_mouse_movements(extract_velocity_and_acceleration(mouse))
+    movements = (
+        mouse
+        .filter(pl.col("mouse_movement_id").is_not_null())
+        .group_by(["segment_id", "mouse_movement_id"])
+        .agg([
+            pl.first("index").alias("start"),
+            pl.last("index").alias("end"),
+            pl.len().alias("n_ticks"),
+            pl.sum("angular_displacement").alias("total_distance"),
+            pl.first("yaw").alias("yaw_start"),
+            pl.first("pitch").alias("pitch_start"),
+            pl.last("yaw").alias("yaw_end"),
+            pl.last("pitch").alias("pitch_end"),
+            *[pl.col(feature).cast(pl.Float64).sum().alias(f"sum_{feature}") for feature in SPEED_FEATURES],
+            *[pl.col(feature).cast(pl.Float64).pow(2).sum().alias(f"sumsq_{feature}") for feature in SPEED_FEATURES],
+            *[pl.min(feature).alias(f"min_{feature}") for feature in SPEED_FEATURES],
+            *[pl.max(feature).alias(f"max_{feature}") for feature in SPEED_FEATURES],
+        ])
+        .drop("mouse_movement_id")
+        .sort("start")
+    )
+
+    presses = pl.concat([
+        ticks
+        .select([
+            "index",
+            "segment_id",
+            pl.col(key).alias("down"),
+            pl.col(key).shift().over("segment_id").fill_null(0).alias("previous"),
+            (pl.col(key).shift() == 1).fill_null(False).alias("held"),
+        ])
+        .filter((pl.col("down") == 1) & (pl.col("previous") == 0))
+        .select(["index", "segment_id", pl.lit(code, dtype=pl.UInt8).alias("key"), "held"])
+        for code, key in enumerate(KEY_FEATURES)
+    ]).sort(["index", "key"])
+
+    segments, teams, movements, rest, runs, presses = pl.collect_all(
+        [segments, teams, movements, aggregate_rest(mouse), extract_key_runs(ticks), presses]
+    )
+    return Partials(segments, teams, movements, rest, runs, presses)
+
+
+def combine(partials: Partials, factor: int) -> pl.DataFrame:
+    """Combine partial aggregates into the features of segments ``factor`` times the base length.
+
+    :param partials: the partial aggregates.
+    :param factor: number of base segments per segment.
+    :return: features for each segment.
+    """
+    # segment IDs are round * 1000 + the index of the segment within the round
+    coarse = ((pl.col("segment_id") // 1000) * 1000 + (pl.col("segment_id") % 1000) // factor).alias("segment_id")
+
+    segments = (
+        partials.segments
+        .lazy()
+        .with_columns(coarse)
+        .group_by("segment_id")
+        .agg(pl.exclude("start").sum(), pl.min("start"))
+    )
+    counts = (
+        segments
+        .select([
+            "segment_id",
+            *[
+                (pl.col(f"keys_down_{n}") / pl.col("n_ticks")).alias(f"keys_down_{n}")
+                for n in range(0, len(KEY_FEATURES) + 1)
+            ],
+            *[f"{key}_presses" for key in KEY_FEATURES],
+        ])
+        .with_columns(total_presses())
+    )
+    teams = partials.teams.lazy().with_columns(coarse).unique()
+
+    features = (
+        segments
+        .select("segment_id")
+        .join(aggregate_segments(_merge_movements(partials, coarse)), on="segment_id", how="left")
+        .join(counts, on="segment_id", how="left")
+        .join(aggregate_key_runs(_merge_runs(partials, coarse)), on="segment_id", how="left")
+        .join(compute_entropy(extract_bigrams(_select_presses(partials, coarse, segments))), on="segment_id",
+              how="left")
+        .fill_null(0)
+        .join(teams, on="segment_id", how="inner")
+        .sort("segment_id")
+        .collect()
+    )
+    return key_features.finalize(features)
+
+
+def _merge_movements(partials: Partials, coarse: pl.Expr) -> pl.LazyFrame:
+    # pieces continue the previous piece if they are in the same segment and their ticks are adjacent
+    starts = (pl.col("segment_id") != pl.col("segment_id").shift()) | (pl.col("start") != pl.col("end").shift() + 1)
+    movements = (
+        partials.movements
+        .lazy()
+        .with_columns(coarse)
+        .with_columns(starts.fill_null(True).cum_sum().alias("movement"))
+        .group_by("movement", maintain_order=True)
+        .agg([
+            pl.first("segment_id"),
+            pl.sum("n_ticks"),
+            pl.sum("total_distance"),
+            pl.first("yaw_start"),
+            pl.first("pitch_start"),
+            pl.last("yaw_end"),
+            pl.last("pitch_end"),
+            pl.col("^sum_.*$").sum(),
+            pl.col("^sumsq_.*$").sum(),
+            pl.col("^min_.*$").min(),
+            pl.col("^max_.*$").max(),
+        ])
+    )
+    return pl.concat([movements.select(movement_columns(is_rest=False)), partials.rest.lazy().with_columns(coarse)])
+
+
+def movement_columns(is_rest: bool) -> list[pl.Expr]:
+    """Convert merged movement pieces into the movement aggregates of ``mouse_features.aggregate_movements``.
+
+    :param is_rest: whether the pieces are ticks at rest.
+    :return: the movement columns, with means and sample standard deviations from the sums and sums of squares.
+    """
+    n = pl.col("n_ticks")
+    mean = [(pl.col(f"sum_{feature}") / n).cast(pl.Float32).alias(f"mean_{feature}") for feature in SPEED_FEATURES]
+    std = [
+        pl.when(n > 1)
+        .then(((pl.col(f"sumsq_{feature}") - pl.col(f"sum_{feature}").pow(2) / n) / (n - 1)).clip(lower_bound=0).sqrt())
+        .cast(pl.Float32)
+        .alias(f"std_{feature}")
+        for feature in SPEED_FEATURES
+    ]
+    return [
+        "segment_id",
+        pl.lit(is_rest).alias("is_rest"),
+        "n_ticks",
+        "total_distance",
+        "yaw_start",
+        "pitch_start",
+        "yaw_end",
+        "pitch_end",
+        *mean,
+        *std,
+        *[f"min_{feature}" for feature in SPEED_FEATURES],
+        *[f"max_{feature}" for feature in SPEED_FEATURES],
+    ]
+
+
+def _merge_runs(partials: Partials, coarse: pl.Expr) -> pl.LazyFrame:
+    # pieces continue the previous piece if they are of the same key, in the same segment and adjacent
+    starts = (
+        (pl.col("key") != pl.col("key").shift())
+        | (pl.col("segment_id") != pl.col("segment_id").shift())
+        | (pl.col("start") != (pl.col("start") + pl.col("length")).shift())
+    )
+    return (
+        partials.runs
+        .lazy()
+        .with_columns(coarse)
+        .with_columns(starts.fill_null(True).cum_sum().alias("run"))
+        .group_by("run", maintain_order=True)
+        .agg([pl.first("key"), pl.first("segment_id"), pl.first("start"), pl.sum("length")])
+        .drop("run")
+    )
+
+
+def _select_presses(partials: Partials, coarse: pl.Expr, segments: pl.LazyFrame) -> pl.LazyFrame:
+    # a key held across a base segment boundary is only a new press at the start of a segment
+    return (
+        partials.presses
+        .lazy()
+        .with_columns(coarse)
+        .join(segments.select(["segment_id", pl.col("start").alias("segment_start")]), on="segment_id", how="left")
+        .filter(pl.col("held").not_() | (pl.col("index") == pl.col("segment_start")))
+        .sort(["index", "key"])
+        .select(["segment_id", "key"])
+    )
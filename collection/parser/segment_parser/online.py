@@ -0,0 +1,321 @@
+import math
+from collections import Counter
+from typing import Any, Mapping
+
+from collection.parser.segment_parser.constants import KEY_FEATURES
+from collection.parser.segment_parser.mouse_features.main import SPEED_FEATURES
+from collection.parser.segment_parser.registry import FEATURES
+
+# see ``mouse_features.extract_mouse_movements``
+AT_REST_THRESHOLD = 0.01
+
+
+class OnlineSegmentExtractor:
+    """Extract the features of a single player from a stream of ticks, one tick at a time.
+
+    Every tick updates running state in constant time, and the feature row of a segment is emitted as soon as it
+    closes. The features are those of ``SegmentParser`` with a single segment length, except for the two features
+    that depend on the whole match, which only see the ticks up to the segment close instead:
+
+        - the entropy of a segment uses the bigram probabilities of all key presses so far.
+        - the segment of the first tick at rest gets the pseudo-movement of the ticks at rest so far (see
+          ``mouse_features.aggregate_movements``).
+    """
+
+    def __init__(self, segment_length: int = 10, tickrate: int = 64):
+        """Constructor.
+
+        :param segment_length: max length of each segment, in seconds.
+        :param tickrate: demo tickrate, default 64Hz.
+        """
+        self._segment_length = segment_length * tickrate
+        self._index = 0
+        self._round = None
+        self._round_start = None
+        self._segment = None
+
+        # state carried across segments, the same way it is in the tick frame of a player
+        self._previous = None
+        self._rest = None
+        self._rest_segment_id = None
+        self._bigram_counts = Counter()
+        self._n_bigrams = 0
+
+    @property
+    def columns(self) -> list[str]:
+        """Names of the emitted features, in order."""
+        return ["segment_id", *FEATURES.columns, "team_num"]
+
+    def update(self, tick: Mapping[str, Any]) -> dict[str, Any] | None:
+        """Add the next tick of the player.
+
+        :param tick: a row of the tick data (see ``extract_tick_df``), only for ticks when the player is alive. Ticks
+                     must be given in order.
+        :return: the features of the previous segment if this tick closes it, None otherwise.
+        """
+        if tick["round"] != self._round:
+            self._round = tick["round"]
+            self._round_start = tick["tick"]
+        segment_id = self._round * 1_000 + (tick["tick"] - self._round_start) // self._segment_length
+
+        closed = None
+        if self._segment is None or segment_id != self._segment.segment_id:
+            closed = self.flush()
+            self._segment = _Segment(segment_id, tick["team_num"])
+        # keys first, they look at the state of the previous tick the mouse update replaces
+        self._update_keys(tick)
+        self._update_mouse(tick)
+        self._segment.n_ticks += 1
+        self._index += 1
+        return closed
+
+    def flush(self) -> dict[str, Any] | None:
+        """Close the current segment, e.g. at the end of the stream.
+
+        :return: the features of the current segment, or None if there is none.
+        """
+        if self._segment is None:
+            return None
+        segment = self._segment
+        self._segment = None
+        segment.end_movement()
+        segment.end_runs(self._index)
+
+        rest = self._rest if segment.segment_id == self._rest_segment_id else None
+        features = {"segment_id": segment.segment_id, **_mouse_features(segment.movements, rest)}
+        features.update(
+            (f"keys_down_{n}", count / segment.n_ticks) for n, count in enumerate(segment.n_keys)
+        )
+        features.update((f"{key}_presses", count) for key, count in zip(KEY_FEATURES, segment.presses))
+        features["total_presses"] = sum(segment.presses)
+        for name, stats in [("transition", segment.transitions), ("duration", segment.durations)]:
+            for key, key_stats in zip(KEY_FEATURES, stats):
+                features[f"min_{key}_{name}"] = key_stats.min or 0
+                features[f"max_{key}_{name}"] = key_stats.max or 0
+                features[f"mean_{key}_{name}"] = key_stats.mean or 0
+                features[f"std_{key}_{name}"] = key_stats.std or 0
+                features[f"sum_{key}_{name}"] = key_stats.count
+        features["entropy"] = sum(
+            -p * math.log(p) for p in (self._bigram_counts[bigram] / self._n_bigrams for bigram in segment.bigrams)
+        )
+        features["team_num"] = segment.team_num
+        return {column: features[column] for column in self.columns}
+
+    def _update_mouse(self, tick: Mapping[str, Any]):
+        # see ``mouse_features.extract_velocity_and_acceleration``
+        yaw, pitch = tick["yaw"], tick["pitch"]
+        if self._previous is None:
+            yaw_delta = pitch_delta = 0.0
+        else:
+            yaw_delta = ((yaw - self._previous["yaw"] + 180) % 360) - 180
+            pitch_delta = pitch - self._previous["pitch"]
+        yaw_speed, pitch_speed = abs(yaw_delta), abs(pitch_delta)
+        if self._previous is None:
+            yaw_speed_acc = pitch_speed_acc = 0.0
+        else:
+            yaw_speed_acc = yaw_speed - self._previous["yaw_speed"]
+            pitch_speed_acc = pitch_speed - self._previous["pitch_speed"]
+        displacement = math.sqrt(yaw_delta ** 2 + pitch_delta ** 2)
+        speeds = (yaw_speed, pitch_speed, yaw_speed_acc, pitch_speed_acc)
+
+        if displacement <= AT_REST_THRESHOLD:
+            self._segment.end_movement()
+            if self._rest is None:
+                self._rest = _Movement()
+                self._rest_segment_id = self._segment.segment_id
+            self._rest.update(yaw, pitch, displacement, speeds)
+        else:
+            if self._segment.movement is None:
+                self._segment.movement = _Movement()
+            self._segment.movement.update(yaw, pitch, displacement, speeds)
+
+        self._previous = {
+            "yaw": yaw,
+            "pitch": pitch,
+            "yaw_speed": yaw_speed,
+            "pitch_speed": pitch_speed,
+            **{key: tick[key] for key in KEY_FEATURES},
+        }
+
+    def _update_keys(self, tick: Mapping[str, Any]):
+        segment = self._segment
+        segment.n_keys[sum(tick[key] for key in KEY_FEATURES)] += 1
+        for code, key in enumerate(KEY_FEATURES):
+            down = tick[key] == 1
+            # n_key_presses looks at the previous tick of the player, across segments
+            if down and self._previous is not None and self._previous[key] == 0:
+                segment.presses[code] += 1
+            # key runs and entropy only look at the previous tick within the segment
+            previous_down = segment.previous_keys is not None and segment.previous_keys[code] == 1
+            if down and not previous_down:
+                segment.start_run(code, self._index)
+                if segment.last_press is not None:
+                    bigram = segment.last_press * len(KEY_FEATURES) + code
+                    segment.bigrams.append(bigram)
+                    self._bigram_counts[bigram] += 1
+                    self._n_bigrams += 1
+                segment.last_press = code
+            elif previous_down and not down:
+                segment.end_run(code, self._index)
+        segment.previous_keys = [tick[key] for key in KEY_FEATURES]
+
+
+class OnlineExtractor:
+    """Extract the features of every player in a stream of ticks, one tick at a time (see ``OnlineSegmentExtractor``).
+    """
+
+    def __init__(self, segment_length: int = 10, tickrate: int = 64):
+        """Constructor.
+
+        :param segment_length: max length of each segment, in seconds.
+        :param tickrate: demo tickrate, default 64Hz.
+        """
+        self._segment_length = segment_length
+        self._tickrate = tickrate
+        self._players = {}
+
+    def update(self, tick: Mapping[str, Any]) -> tuple[int, dict[str, Any]] | None:
+        """Add the next tick of a player.
+
+        :param tick: a row of the tick data, with the ``steamid`` of the player.
+        :return: the steam ID and features of the player's previous segment if this tick closes it, None otherwise.
+        """
+        steamid = tick["steamid"]
+        if steamid not in self._players:
+            self._players[steamid] = OnlineSegmentExtractor(self._segment_length, self._tickrate)
+        features = self._players[steamid].update(tick)
+        return (steamid, features) if features is not None else None
+
+    def flush(self) -> list[tuple[int, dict[str, Any]]]:
+        """Close the current segment of every player, e.g. at the end of the stream.
+
+        :return: the steam ID and features of every closed segment.
+        """
+        closed = [(steamid, player.flush()) for steamid, player in self._players.items()]
+        return [(steamid, features) for steamid, features in closed if features is not None]
+
+
+class _Stats:
+    """Running count, sum, mean, sample standard deviation, min and max (Welford's algorithm)."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.mean = None
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, value: float):
+        self.count += 1
+        self.sum += value
+        delta = value - (self.mean or 0.0)
+        self.mean = (self.mean or 0.0) + delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def std(self) -> float | None:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else None
+
+
+class _Movement:
+    """Running aggregates of a mouse movement, see ``mouse_features.aggregate_movements``."""
+
+    def __init__(self):
+        self.n_ticks = 0
+        self.total_distance = 0.0
+        self.yaw_start = self.pitch_start = self.yaw_end = self.pitch_end = None
+        self.speeds = [_Stats() for _ in SPEED_FEATURES]
+
+    def update(self, yaw: float, pitch: float, displacement: float, speeds: tuple[float, ...]):
+        if self.n_ticks == 0:
+            self.yaw_start, self.pitch_start = yaw, pitch
+        self.yaw_end, self.pitch_end = yaw, pitch
+        self.n_ticks += 1
+        self.total_distance += displacement
+        for stats, speed in zip(self.speeds, speeds):
+            stats.update(speed)
+
+
+class _Segment:
+    """Running state of the segment a player is in."""
+
+    def __init__(self, segment_id: int, team_num: int):
+        self.segment_id = segment_id
+        self.team_num = team_num
+        self.n_ticks = 0
+        self.n_keys = [0] * (len(KEY_FEATURES) + 1)
+        self.presses = [0] * len(KEY_FEATURES)
+        self.previous_keys = None
+
+        self.movement = None
+        self.movements = []
+
+        self._run_starts = [None] * len(KEY_FEATURES)
+        self._run_ends = [None] * len(KEY_FEATURES)
+        self.transitions = [_Stats() for _ in KEY_FEATURES]
+        self.durations = [_Stats() for _ in KEY_FEATURES]
+
+        self.last_press = None
+        self.bigrams = []
+
+    def end_movement(self):
+        if self.movement is not None:
+            self.movements.append(self.movement)
+            self.movement = None
+
+    def start_run(self, code: int, index: int):
+        if self._run_ends[code] is not None:
+            self.transitions[code].update(index - self._run_ends[code])
+        self._run_starts[code] = index
+
+    def end_run(self, code: int, index: int):
+        # the run ended at the previous tick
+        self.durations[code].update(index - self._run_starts[code])
+        self._run_ends[code] = index - 1
+        self._run_starts[code] = None
+
+    def end_runs(self, index: int):
+        for code, start in enumerate(self._run_starts):
+            if start is not None:
+                self.end_run(code, index)
+
+
+def _mouse_features(movements: list[_Movement], rest: _Movement = None) -> dict[str, float]:
+    # see ``mouse_features.aggregate_segments``
+    total_distance, straight_distance, duration = _Stats(), _Stats(), _Stats()
+    means, stds = [_Stats() for _ in SPEED_FEATURES], [_Stats() for _ in SPEED_FEATURES]
+    mins, maxs = [None] * len(SPEED_FEATURES), [None] * len(SPEED_FEATURES)
+    for movement in [*movements, rest] if rest is not None else movements:
+        yaw_delta = ((movement.yaw_end - movement.yaw_start + 180) % 360) - 180
+        pitch_delta = movement.pitch_end - movement.pitch_start
+        total_distance.update(movement.total_distance)
+        straight_distance.update(math.sqrt(yaw_delta ** 2 + pitch_delta ** 2))
+        if movement is not rest:
+            duration.update(movement.n_ticks / 64)  # 64Hz => 64 ticks per second
+        for i, stats in enumerate(movement.speeds):
+            means[i].update(stats.mean)
+            if stats.std is not None:
+                stds[i].update(stats.std)
+            mins[i] = stats.min if mins[i] is None else min(mins[i], stats.min)
+            maxs[i] = stats.max if maxs[i] is None else max(maxs[i], stats.max)
+
+    features = {"n_mouse_movements": len(movements)}
+    for name, stats in [
+        ("total_distance", total_distance),
+        ("straight_distance", straight_distance),
+        ("duration", duration),
+    ]:
+        features[f"mean_{name}"] = stats.mean or 0
+        features[f"std_{name}"] = stats.std or 0
+        features[f"min_{name}"] = stats.min or 0
+        features[f"max_{name}"] = stats.max or 0
+        features[f"sum_{name}"] = stats.sum
+    for i, feature in enumerate(SPEED_FEATURES):
+        features[f"mean_{feature}"] = means[i].mean or 0
+        features[f"std_{feature}"] = stds[i].std or 0
+        features[f"min_{feature}"] = mins[i] or 0
+        features[f"max_{feature}"] = maxs[i] or 0
+    return features
@@ -1,82 +1,365 @@
+import logging
 import os
-from multiprocessing import Pool, cpu_count
+import threading
+from multiprocessing import cpu_count, get_context
+from typing import Iterator
 
 import polars as pl
 from demoparser2 import DemoParser
 
 from collection.parser.abstract_parser import AbstractParser
-from collection.parser.segment_parser import mouse_features
-from collection.parser.segment_parser import key_features
-from collection.parser.segment_parser.util import extract_tick_df, segment_player_df
+from collection.parser.segment_parser import multi_resolution
+from collection.parser.segment_parser import registry
+from collection.parser.segment_parser import sliding
+from collection.parser.segment_parser import streaming
+from collection.parser.segment_parser.feature_dataset import FeatureDataset
+from collection.parser.segment_parser.ipc import read_shared, write_shared
+from collection.parser.segment_parser.tick_cache import TickCache
+from collection.parser.segment_parser.util import extract_tick_df, iter_tick_chunks, segment_player_df
 
 
 class SegmentParser(AbstractParser):
-    def __init__(self, directory: str, segment_length: int = 10, tickrate: int = 64, map_filter: list[str] = None):
+    def __init__(
+            self,
+            directory: str,
+            segment_length: int | list[int] = 10,
+            tickrate: int = 64,
+            map_filter: list[str] = None,
+            processes: int = None,
+            tick_cache: TickCache = None,
+            stride: int = None,
+            output_format: str = "csv",
+            rounds_per_chunk: int = None,
+            features: list[str] = None,
+    ):
         """Construct a new segment parser.
 
         :param directory: directory where samples are stored.
-        :param segment_length: max length of each segment, in seconds
+        :param segment_length: max length of each segment, in seconds. With several lengths, features are extracted
+                               for every length in a single pass over the ticks, and the features of each length are
+                               saved in a ``<length>s`` subdirectory.
         :param tickrate: demo tickrate, default 64Hz.
         :param map_filter: a filter of map names to keep. This parser will skip processing maps if they are not played
                            on a map in this list.
+        :param processes: number of processes players are parsed with, defaults to the CPU count. With 1, players are
+                          parsed in the calling process (e.g. when demos themselves are already parsed in parallel).
+                          The worker processes are started on first use and live until the parser is closed.
+        :param tick_cache: if given, the tick data of every demo is cached, so features can later be re-extracted
+                           with ``CachedSegmentParser``. Demos on maps outside the map filter are cached too.
+        :param stride: if given, segments are sliding windows of ``segment_length`` seconds starting every ``stride``
+                       seconds, with only the additive features (see ``sliding.extract_features``).
+        :param output_format: "csv" to save the features of every player and map as a CSV file, or "parquet" to save
+                              them into a partitioned Parquet dataset in the directory (see ``FeatureDataset``).
+        :param rounds_per_chunk: if given, the ticks of a demo are parsed and featurized this many rounds at a time
+                                 (see ``iter_tick_chunks``), so memory use does not grow with the length of the match.
+                                 Features are unchanged. Players are featurized in the calling process, and neither
+                                 tick caching nor several segment lengths without a stride are supported.
+        :param features: names of feature extractors or columns to extract (see ``registry.FEATURES``), defaults to
+                         all features. Only the extractors and intermediates they depend on are computed. Only
+                         supported with a single segment length, without a stride and without parsing in chunks.
         """
         super().__init__(directory)
         self._tickrate = tickrate
-        self._segment_length = segment_length * self._tickrate
+        segment_lengths = segment_length if isinstance(segment_length, list) else [segment_length]
+        self._segment_lengths = [length * self._tickrate for length in segment_lengths]
         self._map_filter = map_filter
+        self._processes = processes or cpu_count()
+        self._tick_cache = tick_cache
+        self._stride = stride * self._tickrate if stride else None
+        if output_format not in ("csv", "parquet"):
+            raise ValueError(f"unknown output format: {output_format}")
+        self._feature_dataset = FeatureDataset(self._directory) if output_format == "parquet" else None
+        if rounds_per_chunk and tick_cache is not None:
+            raise ValueError("tick caching is not supported when parsing in chunks")
+        if rounds_per_chunk and self._stride is None and len(self._segment_lengths) > 1:
+            raise ValueError("several segment lengths are only supported with a stride when parsing in chunks")
+        self._rounds_per_chunk = rounds_per_chunk
+        if features is not None:
+            if self._stride is not None or len(self._segment_lengths) > 1 or rounds_per_chunk:
+                raise ValueError("feature selection is only supported with a single segment length")
+            # fail early on unknown features
+            registry.FEATURES.resolve(features)
+        self._features = features
+        self._pool = None
+        # the parser may be shared by threads parsing demos concurrently, which must not each start a pool
+        self._pool_lock = threading.Lock()
+
+    def __getstate__(self):
+        # the pool (and its lock) can't (and shouldn't) be sent to worker processes
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        del state["_pool_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool_lock = threading.Lock()
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
 
     def parse_demo(self, path: str, match_id: str, map_id: int):
+        demo = f"{match_id}/{map_id}"
+
         # create demo parser and extract relevant tick information
         demo_parser = DemoParser(path)
 
         # check if demo map is in list to parse.
         map_name = demo_parser.parse_header().get("map_name", "NULL")
-        if self._map_filter and map_name not in self._map_filter:
+        skip = self._map_filter and map_name not in self._map_filter
+        if skip and self._tick_cache is None:
+            return
+
+        if self._rounds_per_chunk:
+            self._featurize_chunks(iter_tick_chunks(demo_parser, self._rounds_per_chunk), match_id, map_id)
             return
 
-        tick_df = extract_tick_df(demo_parser)
+        with self.metrics.timed("parse_ticks", demo=demo) as measurement:
+            tick_df = extract_tick_df(demo_parser)
+            measurement.ticks = tick_df.height
+
+        if self._tick_cache is not None:
+            with self.metrics.timed("cache_ticks", demo=demo) as measurement:
+                measurement.bytes = self._tick_cache.put(tick_df, map_name, match_id, map_id)
+                measurement.ticks = tick_df.height
+        if skip:
+            return
+
+        self.featurize(tick_df, match_id, map_id)
+
+    def featurize(self, tick_df: pl.DataFrame, match_id: str, map_id: int):
+        """Extract and save the features of every player in a demo.
+
+        :param tick_df: the tick DataFrame of the demo.
+        :param match_id: the match ID.
+        :param map_id: the map ID.
+        """
+        demo = f"{match_id}/{map_id}"
 
         # efficiently distribute work across multiple CPU cores
-        with Pool(cpu_count()) as pool:
+        with self.metrics.timed("featurize", demo=demo) as measurement:
+            steamids, feature_dfs = self._parse_players(tick_df)
+            measurement.ticks = tick_df.height
+            measurement.segments = sum(feature_df.height for feature_df in feature_dfs)
+
+        with self.metrics.timed("save", demo=demo):
+            for steamid, feature_df in zip(steamids, feature_dfs):
+                logging.debug(f"{steamid} {feature_df.shape}")
+            self._save_features(dict(zip(steamids, feature_dfs)), match_id, map_id)
+
+    def _featurize_chunks(self, chunks: Iterator[pl.DataFrame], match_id: str, map_id: int):
+        """Extract and save the features of every player in a demo, from the tick data of one chunk at a time.
+
+        :param chunks: the tick DataFrames of consecutive chunks of rounds of the demo.
+        :param match_id: the match ID.
+        :param map_id: the map ID.
+        """
+        demo = f"{match_id}/{map_id}"
+
+        streams = {}
+        while True:
+            with self.metrics.timed("parse_ticks", demo=demo) as measurement:
+                tick_df = next(chunks, None)
+                measurement.ticks = tick_df.height if tick_df is not None else 0
+            if tick_df is None:
+                break
+
+            with self.metrics.timed("featurize", demo=demo) as measurement:
+                for (steamid,), player_df in tick_df.group_by("steamid"):
+                    if steamid not in streams:
+                        streams[steamid] = self._new_streams()
+                    for stream in streams[steamid].values():
+                        stream.update(player_df)
+                measurement.ticks = tick_df.height
+
+        with self.metrics.timed("save", demo=demo):
+            features = {
+                steamid: self._stack_lengths({length: stream.result() for length, stream in player_streams.items()})
+                for steamid, player_streams in streams.items()
+            }
+            self._save_features(features, match_id, map_id)
+
+    def _new_streams(self) -> dict:
+        # a stream per segment length, for a single player
+        if self._stride is not None:
+            return {length: streaming.SlidingStream(length, self._stride) for length in self._segment_lengths}
+        return {length: streaming.SegmentStream(length) for length in self._segment_lengths}
+
+    def _parse_players(self, tick_df: pl.DataFrame) -> tuple[list[int], list[pl.DataFrame]]:
+        """Parse every player in the tick DataFrame.
+
+        With multiple processes, the tick data is written once to an Arrow IPC file in shared memory, sorted by player,
+        and each worker memory-maps the slice of its player. Results come back the same way, so no tick or feature
+        data is pickled.
+
+        :param tick_df: the tick DataFrame of a demo.
+        :return: the steam IDs, and the feature DataFrame of each player.
+        """
+        if self._processes == 1:
             steamids, player_dfs = zip(*tick_df.group_by("steamid"))
-            feature_dfs = pool.map(self._parse_player, player_dfs)
+            return [steamid for steamid, in steamids], [self._parse_player(player_df) for player_df in player_dfs]
 
-        for (steamid,), feature_df in zip(steamids, feature_dfs):
-            print(steamid, feature_df.shape)
-            self._save_features(feature_df, match_id, map_id, steamid)
+        tick_df = tick_df.sort("steamid", maintain_order=True)
+        players = tick_df.group_by("steamid", maintain_order=True).len()
+        offsets = players["len"].cum_sum() - players["len"]
 
-        # player_dfs = [player_df for _, player_df in tick_df.group_by("steamid")]
-        # self._parse_player(player_dfs[0])
+        with self._pool_lock:
+            if self._pool is None:
+                # spawn rather than fork, polars' thread pool does not survive a fork
+                self._pool = get_context("spawn").Pool(self._processes)
+            pool = self._pool
+        tick_path = write_shared(tick_df)
+        feature_paths = []
+        try:
+            # only the settings a worker needs are pickled with every task, not the parser
+            settings = (self._segment_lengths, self._stride, self._tickrate, self._features)
+            tasks = [(tick_path, offset, length, *settings) for offset, length in zip(offsets, players["len"])]
+            results = [pool.apply_async(_parse_shared_player, (task,)) for task in tasks]
+            # wait for every player, even after a failure, so the features of the others are collected and removed
+            errors = []
+            for result in results:
+                try:
+                    feature_paths.append(result.get())
+                except Exception as e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+            return players["steamid"].to_list(), [read_shared(path) for path in feature_paths]
+        finally:
+            # the mappings stay valid after the files are removed
+            for path in [tick_path, *feature_paths]:
+                os.remove(path)
 
     def _parse_player(self, player_df: pl.DataFrame):
-        """Parse a player DataFrame.
+        """Parse a player DataFrame, see ``parse_player``."""
+        return parse_player(player_df, self._segment_lengths, self._stride, self._tickrate, self._features)
 
-        :param player_df: the player DataFrame.
-        :return:
+    def _stack_lengths(self, features: dict[int, pl.DataFrame]) -> pl.DataFrame:
+        """Stack the features of several segment lengths, see ``stack_lengths``."""
+        return stack_lengths(features, self._tickrate)
+
+    def _save_features(self, features: dict[int, pl.DataFrame], match_id, map_id):
+        """Save the features of every player of a demo.
+
+        :param features: the features of every player, by steam ID.
+        :param match_id: the match ID.
+        :param map_id: the map ID.
         """
-        # separate player trajectory into k-second segments
-        segmented_player_df = segment_player_df(player_df, self._segment_length)
-
-        # add team numbers to dataframe (differentiate between T/CT)
-        team_numbers = segmented_player_df.unique(subset=["segment_id", "team_num"]).select(["segment_id", "team_num"])
-
-        mouse_df = mouse_features.extract(segmented_player_df)
-        key_df = key_features.extract(segmented_player_df)
-        features = (
-            mouse_df
-            .join(key_df, on="segment_id", how="inner")
-            .join(team_numbers, on="segment_id", how="inner")
-            .sort("segment_id")
-        )
-        return features
-
-    def _save_features(self, features: pl.DataFrame, match_id, map_id, player_id):
-        filename = f"{match_id}/{map_id}/{player_id}.csv"
+        if self._feature_dataset is not None:
+            self._save_dataset(features, match_id, map_id)
+            return
+        for player_id, player_features in features.items():
+            if "segment_length" in player_features.columns:
+                for (length,), length_features in player_features.partition_by("segment_length", as_dict=True).items():
+                    filename = f"{length}s/{match_id}/{map_id}/{player_id}.csv"
+                    self._save_csv(length_features.drop("segment_length"), filename)
+            else:
+                self._save_csv(player_features, f"{match_id}/{map_id}/{player_id}.csv")
+
+    def _save_dataset(self, features: dict[int, pl.DataFrame], match_id, map_id):
+        # a single file per demo and segment length, with every player
+        if not features:
+            return
+        features = pl.concat([
+            player_features.select([pl.lit(steamid, dtype=pl.UInt64).alias("steamid"), pl.all()])
+            for steamid, player_features in features.items()
+        ])
+        if "segment_length" in features.columns:
+            partitions = features.partition_by("segment_length", as_dict=True, include_key=False)
+        else:
+            partitions = {(self._segment_lengths[0] // self._tickrate,): features}
+        stride = self._stride // self._tickrate if self._stride is not None else None
+        for (length,), length_features in partitions.items():
+            self._feature_dataset.put(length_features, length, match_id, map_id, stride)
+
+    def _save_csv(self, features: pl.DataFrame, filename: str):
         path = os.path.join(self._directory, filename)
         os.makedirs(os.path.dirname(path), exist_ok=True)
         features.write_csv(path)
 
 
+class CachedSegmentParser(SegmentParser):
+    """Segment parser that reads the tick data of demos from a ``TickCache`` instead of parsing .dem files.
+
+    Paths given to this parser are paths of cached demos, and the map filter is not applied (select the cached demos
+    by map instead, see ``TickCache.entries``).
+    """
+
+    def parse_demo(self, path: str, match_id: str, map_id: int):
+        with self.metrics.timed("read_ticks", demo=f"{match_id}/{map_id}") as measurement:
+            tick_df = pl.read_parquet(path)
+            measurement.ticks = tick_df.height
+            measurement.bytes = os.path.getsize(path)
+        self.featurize(tick_df, match_id, map_id)
+
+
+def parse_player(
+        player_df: pl.DataFrame,
+        segment_lengths: list[int],
+        stride: int | None,
+        tickrate: int,
+        features: list[str] | None,
+) -> pl.DataFrame:
+    """Parse a player DataFrame.
+
+    :param player_df: the player DataFrame.
+    :param segment_lengths: the segment lengths, in ticks.
+    :param stride: the stride of sliding windows, in ticks, or None for non-overlapping segments.
+    :param tickrate: the demo tickrate.
+    :param features: names of the features to extract, or None for all features (see ``registry.FEATURES``).
+    :return: the features of every segment. With several segment lengths, the features of all lengths are stacked,
+             with their length (in seconds) in the ``segment_length`` column.
+    """
+    if stride is not None:
+        length_features = {
+            length: sliding.extract_features(player_df, length, stride) for length in segment_lengths
+        }
+    elif len(segment_lengths) > 1:
+        length_features = multi_resolution.extract_features(player_df, segment_lengths)
+    else:
+        length_features = None
+
+    if length_features is not None:
+        return stack_lengths(length_features, tickrate)
+
+    # separate player trajectory into k-second segments
+    segmented_player_df = segment_player_df(player_df, segment_lengths[0])
+
+    # the selected features run as a single query over the shared segment skeleton
+    return registry.extract_features(segmented_player_df, features)
+
+
+def stack_lengths(features: dict[int, pl.DataFrame], tickrate: int) -> pl.DataFrame:
+    """Stack the features of several segment lengths, with their length (in seconds) in a ``segment_length`` column.
+
+    :param features: the features of each segment length, in ticks.
+    :param tickrate: the demo tickrate.
+    :return: the stacked features, or the features themselves with a single segment length.
+    """
+    if len(features) == 1:
+        return next(iter(features.values()))
+    return pl.concat([
+        feature_df.select([pl.lit(length // tickrate, dtype=pl.UInt16).alias("segment_length"), pl.all()])
+        for length, feature_df in features.items()
+    ])
+
+
+def _parse_shared_player(task: tuple) -> str:
+    """Parse a player from a slice of a shared tick DataFrame, in a worker process.
+
+    :param task: the path of the shared tick DataFrame, the offset and length of the player's rows, and the
+                 arguments of ``parse_player``.
+    :return: the path of the shared feature DataFrame.
+    """
+    path, offset, length, *settings = task
+    player_df = read_shared(path).slice(offset, length)
+    return write_shared(parse_player(player_df, *settings))
+
+
 # TODO: TEST, REMOVE!
 if __name__ == "__main__":
     demo_path = "/Users/ktz/msai/msthesis/res/blast-premier-fall-final-2024-g2-vs-spirit-bo3-keEog6FzQxxIbzN28Nh3S0/g2-vs-spirit-m1-dust2.dem"
@@ -0,0 +1,193 @@
+from dataclasses import dataclass, field
+from typing import Callable
+
+import polars as pl
+
+from collection.parser.segment_parser import key_features
+from collection.parser.segment_parser.constants import KEY_FEATURES
+from collection.parser.segment_parser.key_features.entropy import aggregate_entropy
+from collection.parser.segment_parser.key_features.runs import aggregate_key_runs, extract_key_runs
+from collection.parser.segment_parser.mouse_features.main import (
+    SPEED_FEATURES,
+    aggregate_movements,
+    aggregate_segments,
+    extract_mouse_movements,
+    extract_velocity_and_acceleration,
+)
+from collection.parser.segment_parser.util import segment_ids
+
+
+@dataclass
+class Node:
+    """A step of feature extraction.
+
+    Extractors produce segment-level features, a LazyFrame keyed by ``segment_id`` with the declared columns.
+    Intermediates (without columns) produce anything other nodes depend on.
+    """
+    name: str
+    depends: list[str]
+    build: Callable[..., pl.LazyFrame]  # called with the output of every dependency, in order
+    columns: list[str] = field(default_factory=list)
+
+
+class FeatureRegistry:
+    """Registry of feature extractors and the intermediates they depend on, forming a DAG rooted at ``ticks`` (the
+    segmented ticks of a player).
+
+    Only the subgraph needed for a selection of features is built. Every node is built once, and all extractors are
+    joined into a single lazy query, so shared intermediates are computed once and unused columns are pruned by the
+    query optimizer.
+    """
+
+    def __init__(self):
+        self._nodes = {}
+
+    def register(self, name: str, depends: list[str], columns: list[str] = None):
+        """Register a node, decorating the function that builds it.
+
+        :param name: the node name, unique among nodes and columns.
+        :param depends: names of the nodes it depends on.
+        :param columns: the feature columns, for extractors.
+        """
+        def decorator(build):
+            for dependency in depends:
+                if dependency != "ticks" and dependency not in self._nodes:
+                    raise ValueError(f"unknown dependency of {name}: {dependency}")
+            self._nodes[name] = Node(name, depends, build, columns or [])
+            return build
+        return decorator
+
+    @property
+    def extractors(self) -> list[str]:
+        return [node.name for node in self._nodes.values() if node.columns]
+
+    @property
+    def columns(self) -> list[str]:
+        return [column for node in self._nodes.values() for column in node.columns]
+
+    def resolve(self, features: list[str] = None) -> tuple[list[Node], list[str]]:
+        """Resolve a feature selection into the nodes to build.
+
+        :param features: names of extractors or feature columns, defaults to all extractors.
+        :return: the nodes, in dependency order, and the selected columns, in registration order.
+        """
+        selected = set(features if features is not None else self.extractors)
+        unknown = selected - set(self.extractors) - set(self.columns)
+        if unknown:
+            raise ValueError(f"unknown features: {sorted(unknown)}")
+
+        columns = []
+        needed = set()
+        for node in self._nodes.values():
+            node_columns = node.columns if node.name in selected else [c for c in node.columns if c in selected]
+            if node_columns:
+                columns.extend(node_columns)
+                needed.add(node.name)
+
+        # nodes are registered after their dependencies, so registration order is a topological order
+        for node in reversed(self._nodes.values()):
+            if node.name in needed:
+                needed.update(dependency for dependency in node.depends if dependency != "ticks")
+        return [node for node in self._nodes.values() if node.name in needed], columns
+
+    def aggregate(self, ticks: pl.LazyFrame, features: list[str] = None) -> pl.LazyFrame:
+        """Build the lazy query of the selected features of each segment.
+
+        :param ticks: segmented player ticks.
+        :param features: names of extractors or feature columns, defaults to all extractors.
+        :return: the selected features for each segment, with nulls filled with 0.
+        """
+        nodes, columns = self.resolve(features)
+        built = {"ticks": ticks}
+        query = segment_ids(ticks)
+        for node in nodes:
+            built[node.name] = node.build(*[built[dependency] for dependency in node.depends])
+            if node.columns:
+                query = query.join(built[node.name], on="segment_id", how="left")
+        return query.select(["segment_id", *columns]).fill_null(0)
+
+
+def _mouse_columns() -> list[str]:
+    return [
+        "n_mouse_movements",
+        *[
+            f"{stat}_{name}"
+            for name in ["total_distance", "straight_distance", "duration"]
+            for stat in ["mean", "std", "min", "max", "sum"]
+        ],
+        *[f"{stat}_{feature}" for stat in ["mean", "std", "min", "max"] for feature in SPEED_FEATURES],
+    ]
+
+
+def _key_run_columns() -> list[str]:
+    return [
+        f"{stat}_{key}_{name}"
+        for name in ["transition", "duration"]
+        for key in KEY_FEATURES
+        for stat in ["min", "max", "mean", "std", "sum"]
+    ]
+
+
+FEATURES = FeatureRegistry()
+
+
+@FEATURES.register("mouse_ticks", depends=["ticks"])
+def _mouse_ticks(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    return extract_mouse_movements(extract_velocity_and_acceleration(ticks.select(["yaw", "pitch", "segment_id"])))
+
+
+@FEATURES.register("mouse_movements", depends=["mouse_ticks"])
+def _mouse_movements(mouse: pl.LazyFrame) -> pl.LazyFrame:
+    return aggregate_movements(mouse)
+
+
+@FEATURES.register("mouse", depends=["mouse_movements"], columns=_mouse_columns())
+def _mouse(movements: pl.LazyFrame) -> pl.LazyFrame:
+    return aggregate_segments(movements)
+
+
+@FEATURES.register(
+    "key_counts",
+    depends=["ticks"],
+    columns=[
+        *[f"keys_down_{n}" for n in range(0, len(KEY_FEATURES) + 1)],
+        *[f"{key}_presses" for key in KEY_FEATURES],
+        "total_presses",
+    ],
+)
+def _key_counts(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    return key_features.aggregate_counts(ticks)
+
+
+@FEATURES.register("runs", depends=["ticks"])
+def _runs(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    return extract_key_runs(ticks)
+
+
+@FEATURES.register("key_runs", depends=["runs"], columns=_key_run_columns())
+def _key_runs(runs: pl.LazyFrame) -> pl.LazyFrame:
+    return aggregate_key_runs(runs)
+
+
+@FEATURES.register("key_entropy", depends=["ticks"], columns=["entropy"])
+def _key_entropy(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    return aggregate_entropy(ticks)
+
+
+def extract_features(segmented_player_df: pl.DataFrame, features: list[str] = None) -> pl.DataFrame:
+    """Extract the selected features of a segmented player, with their team number.
+
+    :param segmented_player_df: player DataFrame, in segments.
+    :param features: names of extractors or feature columns (see ``FEATURES``), defaults to all extractors.
+    :return: the selected features for each segment.
+    """
+    ticks = segmented_player_df.lazy()
+    # add team numbers to dataframe (differentiate between T/CT)
+    teams = ticks.select(["segment_id", "team_num"]).unique()
+    features = (
+        FEATURES.aggregate(ticks, features)
+        .join(teams, on="segment_id", how="inner")
+        .sort("segment_id")
+        .collect()
+    )
+    return key_features.finalize(features)
@@ -0,0 +1,110 @@
+import polars as pl
+
+from collection.parser.segment_parser.constants import KEY_FEATURES
+
+
+def extract_features(player_df: pl.DataFrame, window_length: int, stride: int) -> pl.DataFrame:
+    """Extract the additive features of a player over sliding (possibly overlapping) windows.
+
+    Windows of ``window_length`` ticks start every ``stride`` ticks from the start of each round, and never span two
+    rounds. Windows are added until the end of the round is covered (or the next window would start after it), so
+    only the last window of a round may be shorter. With a stride equal to the window length, the windows are the
+    segments of ``segment_player_df``.
+
+    Every feature is a sum over the ticks of a window (or such a sum divided by the number of ticks), computed from
+    prefix sums over the player's ticks. The cost is independent of the overlap of the windows. Mouse deltas and key
+    presses are reset at the start of every round.
+
+    Features are:
+        - `n_ticks`: number of ticks in the window.
+        - `total_distance`, `total_yaw_distance`, `total_pitch_distance`: angular distance travelled by the mouse.
+        - `<key>_down`: fraction of ticks the key is held down.
+        - `<key>_presses`, `total_presses`: number of key presses.
+        - `keys_down_<n>`: fraction of ticks n keys are held down.
+
+    :param player_df: the player tick information.
+    :param window_length: the window length, in ticks.
+    :param stride: ticks between the starts of two windows.
+    :return: features for each window, with ``segment_id`` ``round * 1000 + k`` for the k-th window of the round
+             (which starts at tick ``k * stride`` of the round).
+    """
+    ticks = (
+        player_df
+        # subtract min from each round to make ticks start at 0
+        .with_columns((pl.col("tick") - pl.col("tick").min().over("round")).alias("tick"))
+        .sort(["round", "tick"])
+        .with_columns(_position("round", "tick").alias("position"))
+    )
+    additive = ticks.select(_additive_columns())
+
+    windows = (
+        ticks
+        .group_by("round")
+        .agg(
+            pl.max("tick").cast(pl.Int64).alias("max_tick"),
+            (pl.max("tick").cast(pl.Int64) + 1 - window_length).clip(lower_bound=0).alias("uncovered"),
+        )
+        # enough windows to cover the whole round, but none starting after its last tick (with a stride longer than
+        # the window length)
+        .with_columns(
+            pl.int_ranges(
+                0,
+                pl.min_horizontal((pl.col("uncovered") + stride - 1) // stride, pl.col("max_tick") // stride) + 1,
+            ).alias("k")
+        )
+        .explode("k")
+        .with_columns((pl.col("k") * stride).alias("start"))
+        .sort(["round", "start"])
+    )
+    # the window spans the rows [lo, hi) of the tick data
+    lo = ticks["position"].search_sorted(windows.select(_position("round", "start")).to_series(), side="left")
+    hi = ticks["position"].search_sorted(windows.select(_position("round", "start") + window_length).to_series(),
+                                         side="left")
+
+    sums = {}
+    for column in additive.columns:
+        prefix = pl.concat([pl.Series([0], dtype=additive[column].dtype), additive[column].cum_sum()])
+        sums[column] = prefix.gather(hi) - prefix.gather(lo)
+    n_ticks = (hi - lo).alias("n_ticks")
+
+    features = pl.DataFrame({
+        "segment_id": (windows["round"].cast(pl.Int32) * 1_000 + windows["k"].cast(pl.Int32)),
+        "n_ticks": n_ticks,
+        **{name: sums[name] for name in ["total_distance", "total_yaw_distance", "total_pitch_distance"]},
+        **{f"{key}_down": sums[f"{key}_down"] / n_ticks for key in KEY_FEATURES},
+        **{f"{key}_presses": sums[f"{key}_presses"] for key in KEY_FEATURES},
+        **{f"keys_down_{n}": sums[f"keys_down_{n}"] / n_ticks for n in range(0, len(KEY_FEATURES) + 1)},
+        "team_num": ticks["team_num"].gather(lo),
+    })
+    return (
+        features
+        .filter(pl.col("n_ticks") > 0)
+        .with_columns(pl.sum_horizontal([f"{key}_presses" for key in KEY_FEATURES]).alias("total_presses"))
+        .select([pl.exclude("team_num"), "team_num"])
+    )
+
+
+def _position(round_column: str, tick_column: str) -> pl.Expr:
+    # a key increasing over the ticks of the player, which separates rounds
+    return (pl.col(round_column).cast(pl.Int64) * 2 ** 32) + pl.col(tick_column).cast(pl.Int64)
+
+
+def _additive_columns() -> list[pl.Expr]:
+    # per-tick values the window features sum up. Floats are summed in 64-bit, so long prefix sums stay exact enough
+    pitch_delta = pl.col("pitch").cast(pl.Float64).diff().over("round").fill_null(0)
+    yaw_delta = ((pl.col("yaw").cast(pl.Float64).diff().over("round").fill_null(0) + 180) % 360) - 180
+    n_keys = pl.sum_horizontal([pl.col(key).cast(pl.UInt8) for key in KEY_FEATURES])
+    return [
+        (yaw_delta.pow(2) + pitch_delta.pow(2)).sqrt().alias("total_distance"),
+        yaw_delta.abs().alias("total_yaw_distance"),
+        pitch_delta.abs().alias("total_pitch_distance"),
+        *[pl.col(key).cast(pl.UInt32).alias(f"{key}_down") for key in KEY_FEATURES],
+        *[
+            ((pl.col(key).shift().over("round") == 0) & (pl.col(key) == 1))
+            .fill_null(False)
+            .cast(pl.UInt32)
+            .alias(f"{key}_presses")
+            for key in KEY_FEATURES
+        ],
+        *[(n_keys == n).cast(pl.UInt32).alias(f"keys_down_{n}") for n in range(0, len(KEY_FEATURES) + 1)],
+    ]
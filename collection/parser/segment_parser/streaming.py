@@ -0,0 +1,170 @@
+import polars as pl
+
+from collection.parser.segment_parser import key_features
+from collection.parser.segment_parser import sliding
+from collection.parser.segment_parser.key_features.entropy import compute_entropy, extract_bigrams, extract_key_presses
+from collection.parser.segment_parser.mouse_features.main import (
+    SPEED_FEATURES,
+    aggregate_moving,
+    aggregate_segments,
+    extract_mouse_movements,
+    extract_velocity_and_acceleration,
+)
+from collection.parser.segment_parser.multi_resolution import movement_columns
+from collection.parser.segment_parser.util import segment_player_df
+
+# ticks of the previous chunk the next chunk depends on: the mouse acceleration of a tick looks back two ticks
+CONTEXT_TICKS = 2
+
+
+class SegmentStream:
+    """Features of a player, extracted from their ticks a chunk of rounds at a time.
+
+    Features are the same as extracting all ticks at once. Most features only depend on the ticks of their segment,
+    and segments never cross rounds, so they are final once their chunk is processed. The exceptions are kept as
+    small running state until the last chunk:
+
+        - the mouse deltas and key presses of the first tick of a round look at the last tick of the previous round,
+          which is carried over from the previous chunk.
+        - the bigram probabilities of the entropy are taken over the whole match, so the bigrams are kept.
+        - the ticks at rest are aggregated into a single pseudo-movement (see ``mouse_features.aggregate_movements``),
+          kept as sums so the segment it is attributed to can be completed at the end.
+    """
+
+    def __init__(self, segment_length: int):
+        """Constructor.
+
+        :param segment_length: the segment length, in ticks.
+        """
+        self._segment_length = segment_length
+        self._context = None
+        self._features = []
+        self._bigrams = []
+        self._rest = []
+        self._rest_movements = None
+
+    def update(self, player_df: pl.DataFrame):
+        """Extract the features of the next chunk of ticks.
+
+        :param player_df: the player's ticks in the chunk. Chunks must be given in order.
+        """
+        ticks = player_df.with_columns(pl.lit(False).alias("context"))
+        if self._context is not None:
+            ticks = pl.concat([self._context, ticks])
+        self._context = ticks.sort(["round", "tick"]).tail(CONTEXT_TICKS).with_columns(pl.lit(True).alias("context"))
+
+        ticks = segment_player_df(ticks, self._segment_length).lazy()
+        # features of the context ticks' segments were extracted with the previous chunk
+        segments = ticks.filter(pl.col("context").not_()).select("segment_id").unique()
+        teams = ticks.filter(pl.col("context").not_()).select(["segment_id", "team_num"]).unique()
+
+        mouse = ticks.select(["yaw", "pitch", "segment_id", "context"])
+        mouse = extract_mouse_movements(extract_velocity_and_acceleration(mouse)).filter(pl.col("context").not_())
+        movements = aggregate_moving(mouse)
+        features = (
+            segments
+            .join(aggregate_segments(movements), on="segment_id", how="left")
+            .join(key_features.aggregate(ticks).drop("entropy"), on="segment_id", how="left")
+            .fill_null(0)
+            .join(teams, on="segment_id", how="inner")
+        )
+        bigrams = extract_bigrams(extract_key_presses(ticks)).join(segments, on="segment_id", how="semi")
+
+        features, bigrams, rest, movements = pl.collect_all([features, bigrams, _aggregate_rest(mouse), movements])
+        self._features.append(features)
+        self._bigrams.append(bigrams)
+        if not rest.is_empty():
+            if not self._rest:
+                # the pseudo-movement belongs to the segment of the first tick at rest
+                self._rest_movements = movements.filter(pl.col("segment_id") == rest["segment_id"][0])
+            self._rest.append(rest)
+
+    def result(self) -> pl.DataFrame:
+        """Get the features of all chunks.
+
+        :return: features for each segment.
+        """
+        features = pl.concat(self._features)
+        if self._rest:
+            rest = (
+                pl.concat(self._rest)
+                .select([
+                    pl.first("segment_id"),
+                    pl.sum("n_ticks"),
+                    pl.sum("total_distance"),
+                    pl.first("yaw_start"),
+                    pl.first("pitch_start"),
+                    pl.last("yaw_end"),
+                    pl.last("pitch_end"),
+                    pl.col("^sum_.*$").sum(),
+                    pl.col("^sumsq_.*$").sum(),
+                    pl.col("^min_.*$").min(),
+                    pl.col("^max_.*$").max(),
+                ])
+                .select(movement_columns(is_rest=True))
+            )
+            movements = pl.concat([self._rest_movements, rest.cast(self._rest_movements.schema)])
+            features = features.update(aggregate_segments(movements.lazy()).collect().fill_null(0), on="segment_id")
+
+        entropy = compute_entropy(pl.concat(self._bigrams).lazy()).collect()
+        features = (
+            features
+            .join(entropy, on="segment_id", how="left")
+            .with_columns(pl.col("entropy").fill_null(0))
+            .select([pl.exclude("team_num"), "team_num"])
+            .sort("segment_id")
+        )
+        return key_features.finalize(features)
+
+
+class SlidingStream:
+    """Sliding window features of a player (see ``sliding.extract_features``), extracted a chunk of rounds at a time.
+
+    Windows never cross rounds, and mouse deltas and key presses are reset every round, so every chunk is independent.
+    """
+
+    def __init__(self, window_length: int, stride: int):
+        """Constructor.
+
+        :param window_length: the window length, in ticks.
+        :param stride: ticks between the starts of two windows.
+        """
+        self._window_length = window_length
+        self._stride = stride
+        self._features = []
+
+    def update(self, player_df: pl.DataFrame):
+        """Extract the features of the next chunk of ticks.
+
+        :param player_df: the player's ticks in the chunk.
+        """
+        self._features.append(sliding.extract_features(player_df, self._window_length, self._stride))
+
+    def result(self) -> pl.DataFrame:
+        """Get the features of all chunks.
+
+        :return: features for each window.
+        """
+        return pl.concat(self._features).sort("segment_id")
+
+
+def _aggregate_rest(mouse_df: pl.LazyFrame) -> pl.LazyFrame:
+    # mergeable aggregates of the ticks at rest, see ``multi_resolution.movement_columns``
+    return (
+        mouse_df
+        .filter(pl.col("mouse_movement_id").is_null())
+        .select([
+            pl.first("segment_id"),
+            pl.len().alias("n_ticks"),
+            pl.sum("angular_displacement").alias("total_distance"),
+            pl.first("yaw").alias("yaw_start"),
+            pl.first("pitch").alias("pitch_start"),
+            pl.last("yaw").alias("yaw_end"),
+            pl.last("pitch").alias("pitch_end"),
+            *[pl.col(feature).cast(pl.Float64).sum().alias(f"sum_{feature}") for feature in SPEED_FEATURES],
+            *[pl.col(feature).cast(pl.Float64).pow(2).sum().alias(f"sumsq_{feature}") for feature in SPEED_FEATURES],
+            *[pl.min(feature).alias(f"min_{feature}") for feature in SPEED_FEATURES],
+            *[pl.max(feature).alias(f"max_{feature}") for feature in SPEED_FEATURES],
+        ])
+        .filter(pl.col("segment_id").is_not_null())
+    )
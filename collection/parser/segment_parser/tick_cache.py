@@ -0,0 +1,73 @@
+import os
+import threading
+from typing import Iterator
+
+import polars as pl
+
+
+class TickCache:
+    """On-disk cache of the raw tick data of parsed demos (the output of ``extract_tick_df``).
+
+    Demos are stored as zstd-compressed Parquet files at ``<directory>/<map_name>/<match_id>/<map_id>.parquet``, so
+    features can be re-extracted (e.g. with a new segment length, map filter or feature) without downloading and
+    parsing the demos again.
+    """
+
+    def __init__(self, directory: str, compression_level: int = 3):
+        """Constructor.
+
+        :param directory: the cache directory.
+        :param compression_level: zstd compression level.
+        """
+        self._directory = os.path.abspath(directory)
+        self._compression_level = compression_level
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    def path(self, map_name: str, match_id: str, map_id: int) -> str:
+        """Get the path of a cached demo."""
+        return os.path.join(self._directory, map_name, match_id, f"{map_id}.parquet")
+
+    def put(self, tick_df: pl.DataFrame, map_name: str, match_id: str, map_id: int) -> int:
+        """Store the tick data of a demo, replacing any cached version.
+
+        :param tick_df: the tick data.
+        :param map_name: the map the demo is played on.
+        :param match_id: the match ID.
+        :param map_id: the map ID.
+        :return: size of the cached file, in bytes.
+        """
+        path = self.path(map_name, match_id, map_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file and rename, so a crash never leaves a truncated file in the cache
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        tick_df.write_parquet(tmp_path, compression="zstd", compression_level=self._compression_level)
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    def get(self, map_name: str, match_id: str, map_id: int) -> pl.DataFrame | None:
+        """Get the tick data of a cached demo.
+
+        :return: the tick data, or None if the demo is not cached.
+        """
+        path = self.path(map_name, match_id, map_id)
+        return pl.read_parquet(path) if os.path.exists(path) else None
+
+    def entries(self, map_filter: list[str] = None) -> Iterator[tuple[str, str, str, int]]:
+        """Iterate over all cached demos.
+
+        :param map_filter: if given, only demos played on these maps.
+        :return: (path, map name, match ID, map ID) of every cached demo.
+        """
+        if not os.path.isdir(self._directory):
+            return
+        for map_name in sorted(os.listdir(self._directory)):
+            if map_filter and map_name not in map_filter:
+                continue
+            for match_id in sorted(os.listdir(os.path.join(self._directory, map_name))):
+                directory = os.path.join(self._directory, map_name, match_id)
+                for file in sorted(os.listdir(directory)):
+                    if file.endswith(".parquet"):
+                        yield os.path.join(directory, file), map_name, match_id, int(file.removesuffix(".parquet"))
@@ -1,49 +1,108 @@
-import pandas as pd
+from typing import Iterator
+
 import polars as pl
 from demoparser2 import DemoParser
 
-from collection.parser.segment_parser.constants import KEY_FEATURES, MOUSE_FEATURES
+from collection.parser.segment_parser.constants import KEY_FEATURES, MOUSE_FEATURES, TICK_DTYPES
 
 
 def extract_tick_df(demo_parser: DemoParser) -> pl.DataFrame:
     """Extract raw mouse and key dynamics for every player, for every tick in parsed demo.
 
-    Ticks when players are dead or are in warmup are filtered out.
+    Ticks when players are dead or are in warmup are filtered out. Every column is cast to its compact type (see
+    ``TICK_DTYPES``) as soon as it is converted from the parser's pandas frame, so the 64-bit ticks are never copied.
 
     :param demo_parser: demo parser object.
     :return: raw mouse and key dataframe.
     """
-    tick_df = demo_parser.parse_ticks([
+    return _assign_rounds(_parse_ticks(demo_parser), extract_round_starts(demo_parser))
+
+
+def iter_tick_chunks(
+        demo_parser: DemoParser,
+        rounds_per_chunk: int = 1,
+        tail_ticks: int = 64 * 60 * 5,
+) -> Iterator[pl.DataFrame]:
+    """Extract the same ticks as ``extract_tick_df``, a few rounds at a time.
+
+    Every chunk is parsed with its own ``parse_ticks`` call, so only the ticks of a chunk are in memory at once. This
+    costs more parsing time, the demo parser walks the demo once per chunk.
+
+    :param demo_parser: demo parser object.
+    :param rounds_per_chunk: number of rounds in each chunk.
+    :param tail_ticks: the demo length is unknown, so the ticks of the last chunk are requested in windows of this
+                       many ticks, until a window comes back empty.
+    :return: the ticks of every chunk, in order. Chunks never split a round.
+    """
+    round_starts = extract_round_starts(demo_parser)
+    starts = round_starts["tick"].unique().sort().to_list()
+    bounds = starts[::rounds_per_chunk]
+    for start, end in zip(bounds, bounds[1:]):
+        tick_df = _parse_ticks(demo_parser, list(range(start, end)))
+        if not tick_df.is_empty():
+            yield _assign_rounds(tick_df, round_starts)
+
+    # the last chunk (at most rounds_per_chunk rounds, and the tail of the demo) is read in windows, but is only
+    # yielded once every window is read, so its last round is not split across chunks
+    start = bounds[-1] if bounds else 0
+    windows = []
+    while True:
+        tick_df = _parse_ticks(demo_parser, list(range(start, start + tail_ticks)))
+        if tick_df.is_empty():
+            break
+        windows.append(tick_df)
+        start += tail_ticks
+    if windows:
+        yield _assign_rounds(pl.concat(windows), round_starts)
+
+
+def extract_round_starts(demo_parser: DemoParser) -> pl.DataFrame:
+    """Get the start tick of every round.
+
+    :param demo_parser: demo parser object.
+    :return: the tick and round number of every round start, sorted by tick.
+    """
+    return (
+        pl.from_pandas(demo_parser.parse_event("round_start")[["tick", "round"]])
+        .lazy()
+        .cast({"tick": TICK_DTYPES["tick"], "round": TICK_DTYPES["round"]})
+        # in event a round starts multiple times (possibly due to restart?) keep most recent start
+        .unique(subset="round", keep="last", maintain_order=True)
+        .sort("tick")
+        .collect()
+    )
+
+
+def _parse_ticks(demo_parser: DemoParser, ticks: list[int] = None) -> pl.DataFrame:
+    # demoparser2 gives us pandas dataframes, convert pandas to polars for faster processing downstream. Columns are
+    # converted (and dropped from the pandas frame) one at a time, and cast right away, so the 64-bit ticks are never
+    # copied as a whole
+    pandas_df = demo_parser.parse_ticks([
         *KEY_FEATURES,
         *MOUSE_FEATURES,
         "is_alive",
         "team_num"
-    ])
-    tick_df[KEY_FEATURES] = tick_df[KEY_FEATURES].astype(int)
-    tick_df = tick_df[tick_df.is_alive]
-    tick_df = tick_df.drop(columns=["is_alive"])
-
-    # get ticks for each round start event
-    round_start_df = (
-        demo_parser.parse_event("round_start")
-        # in event a round starts multiple times (possibly due to restart?) keep most recent start
-        .drop_duplicates(subset="round", keep="last")
-    )
+    ], ticks=ticks)
+    columns = []
+    for column in list(pandas_df.columns):
+        series = pl.from_pandas(pandas_df.pop(column))
+        columns.append(series.cast(TICK_DTYPES[column]) if column in TICK_DTYPES else series)
+    return pl.DataFrame(columns)
+
+
+def _assign_rounds(tick_df: pl.DataFrame, round_starts: pl.DataFrame) -> pl.DataFrame:
     # assign round numbers to each tick according to extracted start ticks
-    tick_df = (
-        pd.merge_asof(
-            tick_df.sort_values("tick"),
-            round_start_df.sort_values("tick"),
-            left_on="tick", right_on="tick",
-            direction="backward"
-        )
-        .dropna(subset=["round"])
+    return (
+        tick_df
+        .lazy()
+        .cast({column: dtype for column, dtype in TICK_DTYPES.items() if column in tick_df.columns})
+        .filter(pl.col("is_alive"))
+        .drop("is_alive")
+        .sort("tick")
+        .join_asof(round_starts.lazy(), on="tick", strategy="backward")
+        .drop_nulls("round")
+        .collect()
     )
-    tick_df["round"] = tick_df["round"].astype(int)
-
-    # demoparser2 gives us pandas dataframes, convert pandas to polars for faster processing downstream
-    tick_df = pl.from_pandas(tick_df)
-    return tick_df
 
 
 def segment_player_df(player_df: pl.DataFrame, segment_length: int) -> pl.DataFrame:
@@ -70,31 +129,17 @@ def segment_player_df(player_df: pl.DataFrame, segment_length: int) -> pl.DataFr
         )
         .with_columns(
             # combine with round number to create unique segment IDs
-            (pl.col("round") * 1_000 + pl.col("segment_id"))
+            (pl.col("round").cast(pl.Int32) * 1_000 + pl.col("segment_id"))
             .alias("segment_id")
         )
         .sort(["round", "tick"])
     )
 
 
-def fill_segment_ids(df: pl.DataFrame, features: pl.DataFrame) -> pl.DataFrame:
-    """Fill in all segments in the DataFrame with 0 if features could not be extracted.
-
-    This occurs when a segment has no movements, so the row is omitted from feature calculations.
+def segment_ids(ticks: pl.LazyFrame) -> pl.LazyFrame:
+    """Get the skeleton of all segments in the tick data, which features are joined onto.
 
-    :param df: the data.
-    :param features: DataFrame with columns containing extracted features.
-    :return: DataFrame with filled zeros for null values.
+    :param ticks: the segmented tick data.
+    :return: a LazyFrame with the unique segment IDs.
     """
-    return (
-        df
-        .select("segment_id")
-        .unique()
-        .join(
-            features,
-            on="segment_id",
-            how="left",
-        )
-        .sort("segment_id")
-        .fill_null(0)
-    )
+    return ticks.select("segment_id").unique()
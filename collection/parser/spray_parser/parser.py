@@ -5,6 +5,7 @@ import pandas as pd
 from demoparser2 import DemoParser
 
 from collection.parser.abstract_parser import AbstractParser
+from collection.parser.spray_parser.spray_store import SprayStore
 
 
 # save this code snippet potentially
@@ -24,19 +25,43 @@ class SprayParser(AbstractParser):
     classification performance.
     """
 
-    def __init__(self, directory: str, min_shots: int = 5, max_dist: float = 3.0, weapon: str = "weapon_ak47"):
+    def __init__(
+            self,
+            directory: str,
+            min_shots: int | dict[str, int] = 5,
+            max_dist: float | dict[str, float] = 3.0,
+            weapon: str | list[str] = "weapon_ak47",
+            output_format: str = "npy",
+    ):
         """Initialize the spray parser.
 
         :param directory: the resource directory where we should save parsed sprays.
-        :param min_shots: the minimum number of shots that must be fired consecutively to be considered a spray.
+        :param min_shots: the minimum number of shots that must be fired consecutively to be considered a spray. May be
+                          given per weapon, as a dict with an entry for every weapon.
         :param max_dist: the maximum deviation in degrees between shots in a spray. This argument is used to filter
-                         against spray transfers and other scenarios where the spray control "breaks".
-        :param weapon: the weapon to collect spray patterns for. Defaults to the AK-47.
+                         against spray transfers and other scenarios where the spray control "breaks". May be given per
+                         weapon, as a dict with an entry for every weapon.
+        :param weapon: the weapon(s) to collect spray patterns for. Defaults to the AK-47. The sprays of all weapons
+                       are extracted from a single pass over the demo, and tagged with their weapon. With several
+                       weapons, .npy files are named ``<spray_id>_<weapon>.npy`` rather than ``<spray_id>.npy``.
+        :param output_format: "npy" to save every spray as a .npy file, or "store" to append the sprays to a packed
+                              ``SprayStore`` in the resource directory.
         """
         super().__init__(directory)
-        self.min_shots = min_shots
-        self.max_dist = max_dist
-        self.weapon = weapon
+        self.weapons = [weapon] if isinstance(weapon, str) else list(weapon)
+        self.min_shots = self._per_weapon(min_shots, "min_shots")
+        self.max_dist = self._per_weapon(max_dist, "max_dist")
+        if output_format not in ("npy", "store"):
+            raise ValueError(f"unknown output format: {output_format}")
+        self._spray_store = SprayStore(self._directory) if output_format == "store" else None
+
+    def _per_weapon(self, value, name: str) -> dict:
+        if not isinstance(value, dict):
+            return {weapon: value for weapon in self.weapons}
+        missing = set(self.weapons) - set(value)
+        if missing:
+            raise ValueError(f"{name} missing for weapons: {sorted(missing)}")
+        return {weapon: value[weapon] for weapon in self.weapons}
 
     def parse_demo(self, path: str, match_id: str, map_id: int):
         """Parse a demo file and save the sprays to the resource directory.
@@ -45,35 +70,85 @@ class SprayParser(AbstractParser):
         :param match_id: the match ID.
         :param map_id: the map ID.
         """
+        demo = f"{match_id}/{map_id}"
+
         # collect weapon_fire and mouse dataframes
         parser = DemoParser(path)
-        weapon_fire_df = self._get_weapon_fire_df(parser)
-        mouse_df = parser.parse_ticks(["pitch", "yaw"])
-        player_hurt_df = parser.parse_event("player_hurt")
+        with self.metrics.timed("parse_events", demo=demo) as measurement:
+            weapon_fire_df = self._get_weapon_fire_df(parser)
+            player_hurt_df = parser.parse_event("player_hurt")
+            measurement.events = weapon_fire_df.shape[0] + player_hurt_df.shape[0]
+
+        # only sprays with enough shots are kept, and only the ticks they fire at need mouse angles
+        spray_sizes = weapon_fire_df.groupby("spray_id").tick.transform("size")
+        shots_df = weapon_fire_df[spray_sizes >= weapon_fire_df.weapon.map(self.min_shots)]
+        if shots_df.empty:
+            return
+        with self.metrics.timed("parse_ticks", demo=demo) as measurement:
+            mouse_df = parser.parse_ticks(["pitch", "yaw"], ticks=shots_df.tick.unique().tolist())
+            measurement.ticks = mouse_df.shape[0]
 
         # iterate through each spray
-        for spray_id, spray_df in weapon_fire_df.groupby("spray_id"):
-            if spray_df.shape[0] < self.min_shots:
-                continue
-
-            player_id = spray_df.iloc[0].user_steamid
-            combined_df = self._link_player_hurt_df(player_hurt_df, spray_df, player_id)
-            if pd.isna(combined_df.iloc[0].hitgroup) or combined_df.iloc[0].hitgroup not in ["chest", "stomach"]:
-                # first shot must be on target!
-                continue
-
-            # spray data is N x (pitch, yaw) in degrees
-            spray_data = self._link_mouse_df(mouse_df, spray_df, player_id)
+        with self.metrics.timed("sprays", demo=demo) as measurement:
+            measurement.segments = self._parse_sprays(shots_df, mouse_df, player_hurt_df, match_id, map_id)
+
+    def _parse_sprays(
+            self,
+            weapon_fire_df: pd.DataFrame,
+            mouse_df: pd.DataFrame,
+            player_hurt_df: pd.DataFrame,
+            match_id: str,
+            map_id: int,
+    ) -> int:
+        """Extract the sprays from the parsed demo frames, and save them.
+
+        All sprays are linked to their mouse angles and hit events at once, and split into arrays in a single pass.
+
+        :param weapon_fire_df: the weapon fire events of the sprays with enough shots.
+        :param mouse_df: the mouse angles, at least for every tick a shot was fired.
+        :param player_hurt_df: the player_hurt events.
+        :param match_id: the match ID.
+        :param map_id: the map ID.
+        :return: the number of sprays saved.
+        """
+        shots_df = weapon_fire_df[["spray_id", "user_steamid", "weapon", "tick"]]
+
+        # first shot must be on target!
+        first_shots_df = self._link_player_hurt_df(player_hurt_df, shots_df.groupby("spray_id").head(1))
+        first_shots_df = first_shots_df[first_shots_df.hitgroup.isin(["chest", "stomach"])]
+        shots_df = shots_df[shots_df.spray_id.isin(first_shots_df.spray_id)]
+        hitgroups = first_shots_df.set_index("spray_id").hitgroup
+
+        # spray data is N x (pitch, yaw) in degrees, for every tick of every spray
+        spray_df = self._link_mouse_df(mouse_df, shots_df)
+        spray_ids = spray_df.spray_id.to_numpy()
+        boundaries = np.flatnonzero(spray_ids[1:] != spray_ids[:-1]) + 1
+        starts = np.concatenate([[0], boundaries]) if len(spray_df) > 0 else []
+
+        sprays = []
+        metadata = []
+        angles = spray_df[["pitch", "yaw"]].to_numpy()
+        for start, spray_data in zip(starts, np.split(angles, boundaries)):
             # translate spray so it originates from (0, 0)
-            spray_data -= spray_data[0]
+            spray_data = spray_data - spray_data[0]
 
             # skip sprays that "jump" out of control (perhaps a spray transfer?)
             # computed Euclidean distance
+            weapon = spray_df.weapon.iat[start]
             dist = np.abs(np.sqrt(np.sum(np.square(np.diff(spray_data, axis=0)), axis=1)))
-            if np.any(dist > self.max_dist):
+            if np.any(dist > self.max_dist[weapon]):
                 continue
 
-            self._save(spray_data, match_id, map_id, player_id, spray_id)
+            player_id, spray_id = spray_df.user_steamid.iat[start], spray_ids[start]
+            if self._spray_store is None:
+                self._save(spray_data, match_id, map_id, player_id, spray_id, weapon)
+            sprays.append(spray_data)
+            metadata.append((match_id, map_id, player_id, spray_id, weapon, hitgroups[spray_id]))
+
+        if self._spray_store is not None:
+            columns = ["match_id", "map_id", "player_id", "spray_id", "weapon", "hitgroup"]
+            self._spray_store.put(sprays, pd.DataFrame(metadata, columns=columns))
+        return len(sprays)
 
     def _get_weapon_fire_df(self, parser: DemoParser):
         """Given a demo parser, extract a DataFrame containing the weapon fire events.
@@ -81,55 +156,75 @@ class SprayParser(AbstractParser):
         Extra processing is done to aggregate each weapon fire event into a collection of sprays. Each spray is given a
         unique numeric identifier in a new column.
 
-        The weapon fire events are filtered by weapon type. The default is the AK47.
+        The weapon fire events are filtered by weapon type. The default is the AK47. A spray never spans weapons.
 
         :param parser: the demo parser.
         :return: a DataFrame containing the weapon fire events.
         """
-        # slow calls at the start
+        # filter by specific weapons and sort by player ID and tick
         weapon_fire_df = parser.parse_event("weapon_fire")
-        tick_df = parser.parse_ticks(["FIRE", "active_weapon_ammo"], ticks=weapon_fire_df.tick)
-
-        # filter by specific weapon and sort by player ID and tick
-        weapon_fire_df = weapon_fire_df[weapon_fire_df.weapon == self.weapon]
-        weapon_fire_df = weapon_fire_df.sort_values(by=["user_steamid", "tick"])
-
-        # collect spray IDs
-        spray_ids = []
-        current_spray_id = 0
-        for _, weapon_fire_row in weapon_fire_df.iterrows():
-            tick, steamid = weapon_fire_row.tick, int(weapon_fire_row.user_steamid)
-            tick_row = tick_df[(tick_df.tick == tick) & (tick_df.steamid == steamid)]
-            if not tick_row.iloc[0].FIRE:
-                # if FIRE is not down, this weapon fire is start of a new spray
-                current_spray_id = current_spray_id + 1
-            spray_ids.append(current_spray_id)
-        weapon_fire_df["spray_id"] = spray_ids
-
-        weapon_fire_df = weapon_fire_df.reset_index(drop=True)
+        weapon_fire_df = weapon_fire_df[weapon_fire_df.weapon.isin(self.weapons)]
+        weapon_fire_df = weapon_fire_df.sort_values(by=["user_steamid", "tick"]).reset_index(drop=True)
+        if weapon_fire_df.empty:
+            return weapon_fire_df.assign(spray_id=pd.Series(dtype="int64"))
+
+        # FIRE state of the shooter at every weapon fire event, in a single join
+        tick_df = parser.parse_ticks(["FIRE"], ticks=weapon_fire_df.tick.unique().tolist())
+        fire_df = tick_df[["tick", "steamid", "FIRE"]].drop_duplicates(subset=["tick", "steamid"])
+        steamids = weapon_fire_df.user_steamid.astype("int64")
+        held = (
+            pd.DataFrame({"tick": weapon_fire_df.tick, "steamid": steamids})
+            .merge(fire_df, on=["tick", "steamid"], how="left")
+            .FIRE
+            .fillna(False)
+            .astype(bool)
+        )
+
+        # if FIRE is not down, this weapon fire is start of a new spray. A player's first shot always is, so spray IDs
+        # are never shared between players (compared as integers, shift() would cast the steam IDs to float). So is
+        # the first shot after switching weapons
+        steamids = steamids.to_numpy()
+        weapons = weapon_fire_df.weapon.to_numpy()
+        new_player = np.concatenate([[True], steamids[1:] != steamids[:-1]])
+        new_weapon = np.concatenate([[True], weapons[1:] != weapons[:-1]])
+        new_spray = ~held.to_numpy() | new_player | new_weapon
+        weapon_fire_df["spray_id"] = np.cumsum(new_spray)
         return weapon_fire_df
 
-    def _link_mouse_df(self, mouse_df: pd.DataFrame, spray_df: pd.DataFrame, player_id: str):
-        """Link the mouse angles with a spray.
+    def _link_mouse_df(self, mouse_df: pd.DataFrame, shots_df: pd.DataFrame) -> pd.DataFrame:
+        """Link the mouse angles with the shots of every spray.
 
-        :param mouse_df: the mouse angles DataFrame.
-        :param spray_df: the spray DataFrame.
-        :param player_id: the player ID.
-        :return: a NumPy containing the pitch/yaw angles for every tick in the player's spray.
+        :param mouse_df: the mouse angles DataFrame, at least for every tick a shot was fired.
+        :param shots_df: the shots, with spray ID, player ID and tick.
+        :return: the shots with the player's pitch/yaw angles, sorted by spray and tick. Shots without angles are
+                 left out.
+        """
+        # index the angles by player and tick
+        angles_df = mouse_df[["steamid", "tick", "pitch", "yaw"]].drop_duplicates(subset=["steamid", "tick"])
+        return (
+            shots_df
+            .assign(steamid=shots_df.user_steamid.astype("int64"))
+            .merge(angles_df, on=["steamid", "tick"], how="inner")
+            .sort_values(by=["spray_id", "tick"], kind="stable")
+            .reset_index(drop=True)
+        )
+
+    def _link_player_hurt_df(self, player_hurt_df: pd.DataFrame, shots_df: pd.DataFrame) -> pd.DataFrame:
+        """Link the hit events with the shots they were caused by.
+
+        :param player_hurt_df: the player_hurt events.
+        :param shots_df: the shots, with player ID and tick.
+        :return: the shots with the hitgroup of the first player they hit, or NaN if they missed.
         """
-        data_df = mouse_df[mouse_df.tick.isin(spray_df.tick.values)]
-        data_df = data_df[data_df.steamid == int(player_id)]
-        return data_df[["pitch", "yaw"]].to_numpy()
-
-    def _link_player_hurt_df(self, player_hurt_df: pd.DataFrame, spray_df: pd.DataFrame, player_id: str):
-        player_hurt_df = player_hurt_df[player_hurt_df.tick.isin(spray_df.tick.values)]
-        player_hurt_df = player_hurt_df[player_hurt_df.attacker_steamid == player_id]
-        player_hurt_df = player_hurt_df.drop(
-            columns=["user_name", "user_steamid", "weapon", "attacker_name", "attacker_steamid"])
-        combined_df = pd.merge(spray_df, player_hurt_df, on=["tick"], how="outer")
-        return combined_df
-
-    def _save(self, array: np.ndarray, match_id: str, map_id: int, player_id: int, spray_id: int):
+        # index the hits by attacker and tick
+        hits_df = (
+            player_hurt_df[["attacker_steamid", "tick", "hitgroup"]]
+            .drop_duplicates(subset=["attacker_steamid", "tick"])
+            .rename(columns={"attacker_steamid": "user_steamid"})
+        )
+        return shots_df.merge(hits_df, on=["user_steamid", "tick"], how="left")
+
+    def _save(self, array: np.ndarray, match_id: str, map_id: int, player_id: int, spray_id: int, weapon: str):
         """Save the spray to disk.
 
         :param array: the data.
@@ -137,8 +232,11 @@ class SprayParser(AbstractParser):
         :param map_id: the map ID (0, 1, 2, 3, or 4).
         :param player_id: the player ID.
         :param spray_id: the spray ID.
+        :param weapon: the weapon sprayed.
         """
-        filename = f"{match_id}/{map_id}/{player_id}/{spray_id}.npy"
+        # the weapon is only in the name when it can't be told from the parser's configuration
+        name = f"{spray_id}_{weapon}" if len(self.weapons) > 1 else f"{spray_id}"
+        filename = f"{match_id}/{map_id}/{player_id}/{name}.npy"
         path = os.path.join(self._directory, filename)
         os.makedirs(os.path.dirname(path), exist_ok=True)
         np.save(path, array)
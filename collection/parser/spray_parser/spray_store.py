@@ -0,0 +1,187 @@
+import glob
+import io
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# columns of the metadata table of a shard, one row per spray
+METADATA_DTYPES = {
+    "match_id": str,
+    "map_id": "int64",
+    "player_id": "int64",
+    "spray_id": "int64",
+    "weapon": str,
+    "hitgroup": str,
+    "length": "int64",
+    "offset": "int64",
+    "written_at": "float64",
+}
+
+# every shot of a spray is a (pitch, yaw) pair
+VALUES_DTYPE = np.float32
+N_ANGLES = 2
+
+
+class SprayStore:
+    """Packed store of sprays, an alternative to one .npy file per spray.
+
+    Sprays are appended to shards at ``<directory>/shard-<name>/``. A shard holds:
+
+        - ``values.f32``, the (pitch, yaw) angles of every shot of every spray, contiguous float32.
+        - ``sprays.csv``, the metadata table: match, map, player, spray ID, weapon, first-hit group, and the length and
+          offset (in shots) of the spray within the values.
+
+    Every writing process (and thread) appends to a shard of its own, so parallel parsers never share a file. The
+    metadata table is written last, so values of an append that was interrupted are never referenced, and a torn last
+    row of the table is ignored. The store is read with ``load_sprays``.
+    """
+
+    def __init__(self, directory: str):
+        """Constructor.
+
+        :param directory: the store directory.
+        """
+        self._directory = os.path.abspath(directory)
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    def shard_directory(self) -> str:
+        """Get the directory of the shard the calling process and thread append to."""
+        return os.path.join(self._directory, f"shard-{os.getpid()}-{threading.get_ident()}")
+
+    def put(self, sprays: list[np.ndarray], metadata: pd.DataFrame) -> int:
+        """Append the sprays of a demo.
+
+        :param sprays: the sprays, N x (pitch, yaw) arrays.
+        :param metadata: one row per spray, with the match_id, map_id, player_id, spray_id, weapon and hitgroup.
+        :return: the number of bytes appended to the values.
+        """
+        if not sprays:
+            return 0
+        values = np.concatenate(sprays).astype(VALUES_DTYPE)
+        lengths = np.array([len(spray) for spray in sprays], dtype=np.int64)
+
+        directory = self.shard_directory()
+        os.makedirs(directory, exist_ok=True)
+        values_path = os.path.join(directory, "values.f32")
+        metadata_path = os.path.join(directory, "sprays.csv")
+        start = os.path.getsize(values_path) // (N_ANGLES * values.itemsize) if os.path.exists(values_path) else 0
+        metadata = metadata.assign(
+            length=lengths,
+            offset=start + np.cumsum(lengths) - lengths,
+            written_at=time.time(),
+        )[list(METADATA_DTYPES)]
+        with open(values_path, "ab") as file:
+            # the values may have a torn tail from an interrupted append, start at a whole number of shots
+            file.truncate(start * N_ANGLES * values.itemsize)
+            file.write(values.tobytes())
+        with open(metadata_path, "ab") as file:
+            # the table may end in a torn row from an interrupted append, which is dropped
+            n_bytes = _complete_size(metadata_path)
+            file.truncate(n_bytes)
+            file.write(metadata.to_csv(header=n_bytes == 0, index=False).encode())
+        return values.nbytes
+
+
+class Sprays:
+    """Sprays loaded from a ``SprayStore``.
+
+    Indexing returns a view into the values of its shard, never a copy. Use ``subset`` to select sprays by their
+    metadata, e.g. ``sprays.subset(sprays.catalog.hitgroup == "chest")``.
+    """
+
+    def __init__(self, catalog: pd.DataFrame, values: dict[str, np.ndarray]):
+        """Constructor.
+
+        :param catalog: the metadata of every spray, with the shard it is stored in.
+        :param values: the values of every shard, by shard name.
+        """
+        self.catalog = catalog.reset_index(drop=True)
+        self._values = values
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        row = self.catalog.iloc[index]
+        return self._values[row.shard][row.offset:row.offset + row.length]
+
+    def __iter__(self):
+        for shard, offset, length in zip(self.catalog.shard, self.catalog.offset, self.catalog.length):
+            yield self._values[shard][offset:offset + length]
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """Get the offset of every spray within the values of its shard, in shots."""
+        return self.catalog.offset.to_numpy()
+
+    def subset(self, mask) -> "Sprays":
+        """Select sprays, sharing the values of this instance.
+
+        :param mask: a boolean mask (or index labels) over the catalog.
+        :return: the selected sprays.
+        """
+        return Sprays(self.catalog[mask], self._values)
+
+
+def load_sprays(directory: str, memmap: bool = True) -> Sprays:
+    """Load a spray store written by ``SprayStore``.
+
+    A demo that was parsed more than once (e.g. retried) only keeps the sprays of its latest parse.
+
+    :param directory: the store directory.
+    :param memmap: memory-map the values, so only the sprays that are accessed are read. Otherwise, the values of every
+                   shard are read into memory with a single sequential read.
+    :return: the sprays.
+    """
+    catalogs = []
+    values = {}
+    for shard_directory in sorted(glob.glob(os.path.join(directory, "shard-*"))):
+        shard = os.path.basename(shard_directory)
+        metadata_path = os.path.join(shard_directory, "sprays.csv")
+        values_path = os.path.join(shard_directory, "values.f32")
+        if not os.path.exists(metadata_path):
+            continue
+        # drop the torn tail of an interrupted append
+        n_shots = os.path.getsize(values_path) // (N_ANGLES * np.dtype(VALUES_DTYPE).itemsize)
+        if n_shots == 0:
+            continue
+        if memmap:
+            values[shard] = np.memmap(values_path, dtype=VALUES_DTYPE, mode="r", shape=(n_shots, N_ANGLES))
+        else:
+            values[shard] = np.fromfile(values_path, dtype=VALUES_DTYPE, count=n_shots * N_ANGLES).reshape(-1, N_ANGLES)
+        # drop the torn last row of an interrupted append
+        with open(metadata_path, "rb") as file:
+            text = file.read()
+        text = text[:text.rfind(b"\n") + 1]
+        if not text:
+            continue
+        catalogs.append(pd.read_csv(io.BytesIO(text), dtype=METADATA_DTYPES).assign(shard=shard))
+
+    if not catalogs:
+        return Sprays(pd.DataFrame(columns=[*METADATA_DTYPES, "shard"]).astype(METADATA_DTYPES), values)
+    catalog = pd.concat(catalogs, ignore_index=True)
+    latest = catalog.groupby(["match_id", "map_id"]).written_at.transform("max")
+    catalog = catalog[catalog.written_at == latest].sort_values(by=["match_id", "map_id", "player_id", "spray_id"])
+    return Sprays(catalog, values)
+
+
+def _complete_size(path: str, block_size: int = 65_536) -> int:
+    # size of the complete lines of a text file, up to and including its last newline
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as file:
+        end = file.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - block_size)
+            file.seek(start)
+            index = file.read(end - start).rfind(b"\n")
+            if index >= 0:
+                return start + index + 1
+            end = start
+    return 0
@@ -0,0 +1,60 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+from demoparser2 import DemoParser
+
+
+@dataclass
+class DemoHeader:
+    """Summary of a .dem file, read without parsing its ticks."""
+    path: str
+    size: int
+    map_name: str
+    n_ticks: int = None
+    n_rounds: int = None
+
+    def duration(self, tickrate: int = 64) -> float | None:
+        """Get the length of the demo, in seconds."""
+        return self.n_ticks / tickrate if self.n_ticks is not None else None
+
+
+def prescan_demo(path: str) -> DemoHeader:
+    """Read the header and round events of a .dem file.
+
+    This is much cheaper than parsing the ticks: no entities are decoded. The tick count is the tick of the last round
+    end, which leaves out the short tail after the match ends.
+
+    :param path: the .dem file.
+    :return: the demo header. Tick and round counts are None for demos without any completed round.
+    """
+    demo_parser = DemoParser(path)
+    map_name = demo_parser.parse_header().get("map_name", "NULL")
+    round_end = demo_parser.parse_event("round_end")
+    header = DemoHeader(path, os.path.getsize(path), map_name)
+    if len(round_end) > 0:
+        header.n_ticks = int(round_end["tick"].max())
+        header.n_rounds = len(round_end)
+    return header
+
+
+def prescan_demos(paths: list[str], workers: int = None) -> list[DemoHeader]:
+    """Prescan many .dem files in parallel.
+
+    :param paths: the .dem files.
+    :param workers: number of processes, defaults to the CPU count.
+    :return: the header of every demo that could be read, in order. Unreadable demos are logged and left out.
+    """
+    headers = []
+    # spawn rather than fork, polars' thread pool does not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context) as executor:
+        futures = [executor.submit(prescan_demo, path) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                headers.append(future.result())
+            except Exception as e:
+                logging.error(f"could not prescan {path} - {e}")
+    return headers
@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+
+class PageCache:
+    """On-disk cache of downloaded HTML pages.
+
+    Pages are stored gzip-compressed under the SHA-256 of their URL. Entries older than the TTL are treated as
+    missing, and when the cache grows beyond its size limit the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, ttl: float = 7 * 24 * 3600, max_bytes: int = 2 ** 30):
+        """Constructor.
+
+        :param directory: the cache directory.
+        :param ttl: default time-to-live of an entry, in seconds.
+        :param max_bytes: max total size of the cache on disk.
+        """
+        self._directory = os.path.abspath(directory)
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self._directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+
+    def get(self, url: str, ttl: float = None) -> str | None:
+        """Get a cached page.
+
+        :param url: the page URL.
+        :param ttl: time-to-live for this lookup, overriding the default (e.g. shorter for pages that change often).
+        :return: the page HTML, or None if the page is not cached or has expired.
+        """
+        path = self._path(url)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        # creation time is kept in the modification time, the access time tracks recency for eviction
+        if time.time() - stat.st_mtime > (self._ttl if ttl is None else ttl):
+            return None
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            html = f.read()
+        os.utime(path, (time.time(), stat.st_mtime))
+        return html
+
+    def put(self, url: str, html: str):
+        """Store a page, evicting least recently used pages if the cache is full.
+
+        :param url: the page URL.
+        :param html: the page HTML.
+        """
+        path = self._path(url)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(html)
+        with self._lock:
+            if os.path.exists(path):
+                self._size -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._size += os.path.getsize(path)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # drop least recently used entries until the cache is 10% below its limit, so evictions don't run on every put
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_atime)
+        for entry in entries:
+            if self._size <= self._max_bytes * 0.9:
+                break
+            self._size -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def _entries(self):
+        return (entry for entry in os.scandir(self._directory) if entry.name.endswith(".html.gz"))
+
+    def _path(self, url: str) -> str:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self._directory, f"{key}.html.gz")
@@ -1,13 +1,28 @@
+import asyncio
 import logging
 import os.path
+import shutil
+from dataclasses import replace
+from typing import Iterator
 
 import patoolib
+import rarfile
 import stealth_requests as requests
-from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+from playwright.async_api import async_playwright
+from selectolax.lexbor import LexborHTMLParser
 
+from collection.scraper.cache import PageCache
 from collection.scraper.urls import ResultsUrl
 
+# size of the buffers used to download and extract archives
+CHUNK_SIZE = 1 << 20
+# number of matches on a results page
+RESULTS_PAGE_SIZE = 100
+# elements every complete page has, so error and bot check pages are never taken for (or cached as) real pages
+RESULTS_PAGE_SELECTOR = "div.results"
+MATCH_PAGE_SELECTOR = "div.match-page"
+
 
 class HltvScraper:
     """HLTV data scraper.
@@ -15,37 +30,119 @@ class HltvScraper:
     This object is used to collect demo files for downstream ML tasks.
     """
 
-    def __init__(self, headless: bool = False):
+    def __init__(
+            self,
+            headless: bool = False,
+            max_pages: int = 8,
+            cache: PageCache = None,
+            results_url: ResultsUrl = None,
+            results_ttl: float = 3600,
+            retries: int = 2,
+    ):
+        """Constructor.
+
+        A single browser is started on first use and reused by every call, until the scraper is closed.
+
+        :param headless: whether to run the browser headless.
+        :param max_pages: max number of pages fetched at once.
+        :param cache: if given, downloaded pages are cached, and cached pages are not downloaded again.
+        :param results_url: the results query to scrape matches from (date range, match type, ...). The offset is
+                            ignored.
+        :param results_ttl: max age of a cached results page, in seconds. Results pages change whenever new matches
+                            are played, unlike match pages.
+        :param retries: number of times a page that failed to load (e.g. timed out) is retried.
+        """
         self.headless = headless
+        self.max_pages = max_pages
+        self.cache = cache
+        self.results_url = results_url or ResultsUrl()
+        self.results_ttl = results_ttl
+        self.retries = retries
+        self._loop = asyncio.new_event_loop()
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._semaphore = None
+        self._cookies_lock = None
+        self._cookies_accepted = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the browser."""
+        if self._browser is not None:
+            self._loop.run_until_complete(self._close_browser())
+        self._loop.close()
+
+    def scrape_match_hrefs(self, known: set[str] = None) -> list[str]:
+        """Scrape match hrefs from the results pages, newest first.
+
+        Pages are walked until one has no matches. If known hrefs are given, the walk stops early at the first page
+        containing only known hrefs, so only the matches played since the last scrape are fetched.
 
-    def scrape_match_hrefs(self) -> list[str]:
+        :param known: match hrefs that were scraped before.
+        :return: the match hrefs, newest first. May contain known hrefs from the last page visited.
+        """
         hrefs = []
-        # 1574 hardcoded in
-        for offset in range(0, 1574, 100):
-            page_html = self._download_html(str(ResultsUrl(offset=offset)))
-            page_hrefs = self._match_hrefs_from_html(page_html)
-            hrefs.extend(page_hrefs)
-        return hrefs
+        offset = 0
+        # an incremental scrape usually stops after a page or two, so don't fetch pages ahead of time
+        batch_size = 1 if known else self.max_pages
+        while True:
+            urls = [
+                str(replace(self.results_url, offset=offset + i * RESULTS_PAGE_SIZE))
+                for i in range(batch_size)
+            ]
+            offset += batch_size * RESULTS_PAGE_SIZE
+            for url, page_html in zip(urls, self._download_htmls(urls, RESULTS_PAGE_SELECTOR, ttl=self.results_ttl)):
+                if page_html is None:
+                    # a missing page can't be told apart from the end of the results
+                    raise RuntimeError(f"could not download results page {url}")
+                page_hrefs = self._match_hrefs_from_html(page_html)
+                hrefs.extend(page_hrefs)
+                if not page_hrefs or (known and known.issuperset(page_hrefs)):
+                    return hrefs
 
     def scrape_demo_hrefs(self, match_hrefs: list[str]) -> list[str]:
-        hrefs = []
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=False)
-            for match_href in match_hrefs:
-                context = browser.new_context()
-                page = context.new_page()
-                page.goto("https://www.hltv.org" + match_href)
-                # page.get_by_text("Allow all cookies").click()
-                html = page.content()
-                page.close()
-                soup = BeautifulSoup(html, "html.parser")
-                for a_tag in soup.find_all("a", {"href": True}):
-                    if a_tag["href"].startswith("/download/demo"):
-                        print(a_tag["href"])
-                        hrefs.append(a_tag["href"])
+        """Scrape the demo hrefs of matches. Matches whose page could not be downloaded are logged and left out.
+
+        :param match_hrefs: the match hrefs.
+        :return: the demo hrefs.
+        """
+        return [
+            href
+            for hrefs in self.scrape_match_demo_hrefs(match_hrefs).values()
+            if hrefs is not None
+            for href in hrefs
+        ]
+
+    def scrape_match_demo_hrefs(self, match_hrefs: list[str]) -> dict[str, list[str] | None]:
+        """Scrape the demo hrefs of every match.
+
+        :param match_hrefs: the match hrefs.
+        :return: the demo hrefs of every match, or None for matches whose page could not be downloaded.
+        """
+        urls = ["https://www.hltv.org" + match_href for match_href in match_hrefs]
+        hrefs = {}
+        for match_href, html in zip(match_hrefs, self._download_htmls(urls, MATCH_PAGE_SELECTOR)):
+            hrefs[match_href] = self._demo_hrefs_from_html(html) if html is not None else None
+            logging.debug(hrefs[match_href])
         return hrefs
 
     def scrape_demos(self, demo_href: str, out: str) -> None:
+        archive_path = self.download_archive(demo_href, out)
+        self.extract_archive(archive_path, out)
+
+    def download_archive(self, demo_href: str, out: str) -> str:
+        """Download the RAR archive behind a demo href.
+
+        :param demo_href: the demo href.
+        :param out: the directory to write the archive to.
+        :return: the path of the downloaded archive.
+        """
         url = "https://www.hltv.org" + demo_href
         r = requests.get(url, stream=True)
         r.raise_for_status()
@@ -56,34 +153,148 @@ class HltvScraper:
         archive_name = url.split('/')[-1] + ".rar"
         archive_path = os.path.join(out, archive_name)
         with open(archive_path, "wb") as f:
-            for chunk in r.iter_content():
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
                 f.write(chunk)
 
         logging.debug("archive downloaded")
+        return archive_path
 
-        # extract RAR archive contents to same directory
+    def extract_archive(self, archive_path: str, out: str) -> None:
+        """Extract a downloaded RAR archive.
+
+        :param archive_path: the path of the archive.
+        :param out: the directory to extract the archive contents to.
+        """
         patoolib.extract_archive(archive_path, outdir=out, verbosity=-1)  # silence logs
 
         logging.debug("archive extracted")
 
-    def _download_html(self, url: str) -> str:
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=False)
-            context = browser.new_context()
-            page = context.new_page()
-            page.goto(url)
+    def iter_demos(self, archive_path: str, out: str) -> Iterator[str]:
+        """Extract the .dem files of a RAR archive one at a time.
+
+        Each .dem file is extracted only when the next one is requested, and is deleted as soon as the caller asks for
+        the one after it. Together with the archive itself, only a single demo is ever on disk at once.
+
+        :param archive_path: the path of the archive.
+        :param out: the directory to extract the demos to.
+        :return: iterator over the paths of the extracted .dem files.
+        """
+        with rarfile.RarFile(archive_path) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or not member.filename.endswith(".dem"):
+                    continue
+                path = os.path.join(out, os.path.basename(member.filename))
+                with archive.open(member) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                logging.debug(f"extracted {member.filename}")
+                try:
+                    yield path
+                finally:
+                    os.remove(path)
+
+    def _download_html(self, url: str, selector: str) -> str:
+        return self._download_htmls([url], selector)[0]
+
+    def _download_htmls(self, urls: list[str], selector: str, ttl: float = None) -> list[str | None]:
+        """Download the HTML of many pages, up to ``max_pages`` at once.
+
+        A page that fails to load does not stop the others. Failed pages are retried, and logged if they still fail. A
+        page fails if its response is an error (e.g. 403 or 429), or if it lacks the selected element (e.g. a bot check
+        page). Failed pages are never cached.
+
+        :param urls: the page URLs.
+        :param selector: CSS selector of an element every complete page has.
+        :param ttl: max age of cached pages, defaults to the cache's TTL.
+        :return: the HTML of every page (None for pages that failed), in the same order as the URLs.
+        """
+        return self._loop.run_until_complete(self._fetch_all(urls, selector, ttl))
+
+    async def _fetch_all(self, urls: list[str], selector: str, ttl: float = None) -> list[str]:
+        htmls = [self.cache.get(url, ttl=ttl) if self.cache else None for url in urls]
+        # pages cached before they were checked may be incomplete
+        htmls = [html if html is not None and _has_element(html, selector) else None for html in htmls]
+        missing = [i for i, html in enumerate(htmls) if html is None]
+        logging.debug(f"{len(urls) - len(missing)} of {len(urls)} pages cached")
+        if missing:
+            await self._open_browser()
+        for attempt in range(self.retries + 1):
+            if not missing:
+                break
+            if attempt > 0:
+                logging.info(f"retrying {len(missing)} pages")
+                await asyncio.sleep(2 ** attempt)
+            fetched = await asyncio.gather(*(self._fetch(urls[i], selector) for i in missing), return_exceptions=True)
+            failed = []
+            for i, html in zip(missing, fetched):
+                if isinstance(html, Exception):
+                    logging.debug(f"could not download {urls[i]} - {html}")
+                    failed.append(i)
+                else:
+                    htmls[i] = html
+            missing = failed
+        for i in missing:
+            logging.error(f"could not download {urls[i]}")
+        return htmls
 
-            page.get_by_text("Allow all cookies").click()
-            return page.content()
+    async def _fetch(self, url: str, selector: str) -> str:
+        async with self._semaphore:
+            page = await self._context.new_page()
+            try:
+                response = await page.goto(url)
+                if response is None or not response.ok:
+                    raise RuntimeError(f"status {response.status if response else None}")
+                await self._accept_cookies(page)
+                html = await page.content()
+            finally:
+                await page.close()
+        if not _has_element(html, selector):
+            raise RuntimeError(f"{selector} not found")
+        if self.cache:
+            self.cache.put(url, html)
+        return html
+
+    async def _accept_cookies(self, page):
+        # consent is stored in the shared browser context, so the banner only has to be clicked away once. Only the
+        # first page looks for it, whether or not it is found, so pages without a banner don't wait for the timeout
+        if self._cookies_accepted:
+            return
+        async with self._cookies_lock:
+            if self._cookies_accepted:
+                return
+            try:
+                await page.get_by_text("Allow all cookies").click(timeout=5_000)
+            except PlaywrightTimeoutError:
+                logging.debug("no cookie banner")
+            finally:
+                self._cookies_accepted = True
+
+    async def _open_browser(self):
+        if self._browser is not None:
+            return
+        self._playwright = await async_playwright().start()
+        self._browser = await self._playwright.chromium.launch(headless=self.headless)
+        self._context = await self._browser.new_context()
+        self._semaphore = asyncio.Semaphore(self.max_pages)
+        self._cookies_lock = asyncio.Lock()
+
+    async def _close_browser(self):
+        await self._context.close()
+        await self._browser.close()
+        await self._playwright.stop()
+        self._browser = None
 
     def _match_hrefs_from_html(self, html: str) -> list[str]:
-        hrefs = []
-        soup = BeautifulSoup(html, "html.parser")
+        tree = LexborHTMLParser(html)
 
-        if results_div := soup.find("div", {"class": "results"}):
-            for a_tag in results_div.find_all("a", {"href": True}):
-                if a_tag["href"].startswith("/matches"):
-                    hrefs.append(a_tag["href"])
-            return hrefs
+        if results_div := tree.css_first("div.results"):
+            return [a_tag.attributes["href"] for a_tag in results_div.css('a[href^="/matches"]')]
         else:
             raise ValueError("results not found")
+
+    def _demo_hrefs_from_html(self, html: str) -> list[str]:
+        tree = LexborHTMLParser(html)
+        return [a_tag.attributes["href"] for a_tag in tree.css('a[href^="/download/demo"]')]
+
+
+def _has_element(html: str, selector: str) -> bool:
+    return LexborHTMLParser(html).css_first(selector) is not None
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from datetime import date
 
 
 # modeled off this URL, which is all matches from 2024:
@@ -7,7 +8,7 @@ from dataclasses import dataclass
 @dataclass
 class ResultsUrl:
     start_date: str = "2024-01-01"
-    end_date: str = "2024-12-31"
+    end_date: str | None = "2024-12-31"  # None for today, e.g. for incremental scrapes
     content: str = "demo"
     game_type: str = "CS2"
     match_type: str = "Lan"
@@ -18,7 +19,7 @@ class ResultsUrl:
             f"https://www.hltv.org/results?"
             f"offset={self.offset}&"
             f"startDate={self.start_date}&"
-            f"endDate={self.end_date}&"
+            f"endDate={self.end_date or date.today().isoformat()}&"
             f"content={self.content}&"
             f"gameType={self.game_type}&"
             f"matchType={self.match_type}"
@@ -0,0 +1,89 @@
+import logging
+import threading
+from dataclasses import dataclass
+from queue import Queue
+from typing import Any, Callable, Iterable
+
+from collection.metrics import PipelineMetrics
+
+# sentinel placed on a queue to tell a worker that no more items will arrive
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """A single stage of a staged pipeline.
+
+    Each stage runs ``workers`` threads which take items from the stage's input queue, apply ``fn``, and put the
+    result on the input queue of the next stage. If ``fn`` returns None, the item is dropped.
+
+    :param name: name of the stage, used for logging.
+    :param fn: function applied to every item passing through this stage.
+    :param workers: number of worker threads for this stage.
+    :param queue_size: max number of items waiting in front of this stage. Bounds memory/disk use when a downstream
+                       stage is slower than an upstream one.
+    """
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    queue_size: int = 2
+
+
+def run_stages(items: Iterable, stages: list[Stage], metrics: PipelineMetrics = None) -> list:
+    """Run items through a chain of stages, with every stage working concurrently.
+
+    Stages are connected by bounded queues, so the throughput of the chain is limited by its slowest stage rather than
+    the sum of all stages. Exceptions raised by a stage are logged and the item is dropped, the other items carry on.
+
+    :param items: the items fed into the first stage.
+    :param stages: the stages, in order.
+    :param metrics: if given, the depth of the queue in front of each stage is tracked as gauge ``queue_<stage>``.
+    :return: the outputs of the last stage, in order of completion.
+    """
+    queues = [Queue(maxsize=stage.queue_size) for stage in stages]
+    results = []
+
+    def work(index: int):
+        stage = stages[index]
+        out = queues[index + 1] if index + 1 < len(stages) else None
+        while (item := queues[index].get()) is not _DONE:
+            if metrics is not None:
+                metrics.set_gauge(f"queue_{stage.name}", queues[index].qsize())
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                logging.error(f"stage {stage.name} failed on {item} - {e}")
+                continue
+            if result is None:
+                continue
+            if out is None:
+                results.append(result)
+            else:
+                out.put(result)
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+        for _ in range(stages[0].workers):
+            queues[0].put(_DONE)
+
+    threads = [threading.Thread(target=feed, name="feed", daemon=True)]
+    pools = []
+    for index, stage in enumerate(stages):
+        pool = [
+            threading.Thread(target=work, args=(index,), name=f"{stage.name}-{n}", daemon=True)
+            for n in range(stage.workers)
+        ]
+        pools.append(pool)
+        threads.extend(pool)
+    for thread in threads:
+        thread.start()
+
+    # shut stages down in order: once every worker of a stage exits, nothing more reaches the next stage
+    for index, pool in enumerate(pools):
+        for thread in pool:
+            thread.join()
+        if index + 1 < len(stages):
+            for _ in range(stages[index + 1].workers):
+                queues[index + 1].put(_DONE)
+    return results
@@ -4,7 +4,7 @@ import numpy as np
 import pandas as pd
 
 
-def load_catalog(directory: str, extension: str = ".npy"):
+def load_catalog(directory: str, extension: str = ".npy", weapon: str = "weapon_ak47"):
     data = []
     for match_id in os.listdir(directory):
         if not match_id.isnumeric():
@@ -28,7 +28,11 @@ def load_catalog(directory: str, extension: str = ".npy"):
     for idx, row in df.iterrows():
         filename = f"{row.match_id}/{row.map_id}/{row.player_id}/{row.filename}"
         path = os.path.join(directory, filename)
-        array = np.load(path)
+        array = np.load(path, mmap_mode="r")
         lengths.append(array.shape[0])
     df["length"] = lengths
+    # sprays of multi-weapon runs are saved as <spray_id>_<weapon>.npy, those of single-weapon runs as <spray_id>.npy,
+    # which are assumed to be sprays of the given weapon
+    stems = df.filename.str.removesuffix(extension).str.split("_", n=1)
+    df["weapon"] = stems.str[1].fillna(weapon)
     return df